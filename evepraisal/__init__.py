@@ -30,6 +30,116 @@ app.config['VALID_SOLAR_SYSTEMS'] = {
 }
 app.config['USER_AGENT'] = 'Evepraisal/1.0 +http://roflcows.com/'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['CREST_URL'] = os.environ.get(
+    "CREST_URL", "https://crest-tq.eveonline.com")
+# Upper bound on concurrent CREST order book requests per appraisal.
+# Set to 1 to fetch one type at a time.
+app.config['CREST_MAX_IN_FLIGHT'] = int(
+    os.environ.get("CREST_MAX_IN_FLIGHT", "8"))
+# Pull the complete order book of a hub's region once per
+# CREST_REGION_REFRESH_INTERVAL instead of asking CREST type by type.
+app.config['CREST_REGION_BULK'] = os.environ.get(
+    "CREST_REGION_BULK", "false").lower() == "true"
+app.config['CREST_REGION_REFRESH_INTERVAL'] = 60 * 60
+# Keep-alive connections kept open per provider host. Requests beyond this
+# wait for a free connection.
+app.config['HTTP_POOL_SIZE'] = int(os.environ.get("HTTP_POOL_SIZE", "8"))
+app.config['HTTP_CONNECT_TIMEOUT'] = float(
+    os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+app.config['HTTP_READ_TIMEOUT'] = float(
+    os.environ.get("HTTP_READ_TIMEOUT", "30"))
+# A provider is skipped for PROVIDER_COOLDOWN seconds after this many failed
+# calls in a row.
+app.config['PROVIDER_FAILURE_THRESHOLD'] = int(
+    os.environ.get("PROVIDER_FAILURE_THRESHOLD", "3"))
+app.config['PROVIDER_COOLDOWN'] = int(
+    os.environ.get("PROVIDER_COOLDOWN", "60"))
+# Seconds to wait on a provider before also asking the next one and using
+# whichever answers first. 0 disables hedging.
+app.config['PROVIDER_HEDGE_AFTER'] = float(
+    os.environ.get("PROVIDER_HEDGE_AFTER", "0"))
+app.config['PRICE_CACHE_TIMEOUT'] = 10 * 60 * 60
+# Cached prices older than this are still served, but refreshed in the
+# background. PRICE_CACHE_TIMEOUT remains the hard limit.
+app.config['PRICE_CACHE_STALE_AFTER'] = 60 * 60
+# Types no provider could price, or only found without volume, aren't asked
+# for again for this long.
+app.config['PRICE_NEGATIVE_CACHE_TIMEOUT'] = 15 * 60
+# Concurrent requests missing the same price wait for the one fetching it
+# instead of asking the providers again, for up to PRICE_COALESCE_TIMEOUT
+# seconds.
+app.config['PRICE_COALESCE'] = os.environ.get(
+    "PRICE_COALESCE", "true").lower() == "true"
+app.config['PRICE_COALESCE_TIMEOUT'] = 10
+# Local SQLite price snapshots consulted when memcached misses. An empty path
+# disables the store.
+app.config['PRICE_STORE_PATH'] = os.environ.get(
+    "PRICE_STORE_PATH", os.path.join(os.getcwd(), 'data', 'prices.db'))
+app.config['PRICE_STORE_MAX_AGE'] = app.config['PRICE_CACHE_TIMEOUT']
+# Parse results shared by every worker, keyed by paste and type database
+# version. The least recently used ones are evicted beyond
+# PARSE_CACHE_MAX_BYTES. An empty path disables the cache.
+app.config['PARSE_CACHE_PATH'] = os.environ.get(
+    "PARSE_CACHE_PATH", os.path.join(os.getcwd(), 'data', 'parses.db'))
+app.config['PARSE_CACHE_MAX_BYTES'] = int(
+    os.environ.get("PARSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Try the parsers the first lines of a paste look like they were meant for
+# before the others.
+app.config['PARSE_SNIFF'] = os.environ.get(
+    "PARSE_SNIFF", "true").lower() == "true"
+# Pastes over PASTE_MAX_LINES non-empty lines or PASTE_MAX_BYTES bytes are
+# rejected before they are parsed, and request bodies that can't hold a paste
+# under the limit (form encoding takes up to 3 bytes per byte) before they are
+# read.
+app.config['PASTE_MAX_LINES'] = int(
+    os.environ.get("PASTE_MAX_LINES", "100000"))
+app.config['PASTE_MAX_BYTES'] = int(
+    os.environ.get("PASTE_MAX_BYTES", str(4 * 1024 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = (3 * app.config['PASTE_MAX_BYTES'] +
+                                    64 * 1024)
+# Pastes of at least STREAM_PARSE_MIN_LINES lines in a format whose lines are
+# parsed independently (listings, cargo scans, assets, contracts, wallets)
+# are parsed STREAM_PARSE_CHUNK_LINES lines at a time, merging the
+# quantities of identical items as they go. No more than
+# STREAM_PARSE_MAX_BAD_LINES unparsed lines are kept.
+app.config['STREAM_PARSE_MIN_LINES'] = int(
+    os.environ.get("STREAM_PARSE_MIN_LINES", "5000"))
+app.config['STREAM_PARSE_CHUNK_LINES'] = 1000
+app.config['STREAM_PARSE_MAX_BAD_LINES'] = 1000
+# Pastes parsed in chunks with at least PARSE_POOL_MIN_LINES lines are split
+# into chunks of PARSE_POOL_CHUNK_LINES lines and parsed by a pool of
+# PARSE_POOL_PROCESSES processes started by each web worker. 0 disables the
+# pool. Pastes are parsed in the web worker again when a chunk takes longer
+# than PARSE_POOL_TIMEOUT seconds or the pool fails.
+app.config['PARSE_POOL_PROCESSES'] = int(
+    os.environ.get("PARSE_POOL_PROCESSES", "0"))
+app.config['PARSE_POOL_MIN_LINES'] = int(
+    os.environ.get("PARSE_POOL_MIN_LINES", "20000"))
+app.config['PARSE_POOL_CHUNK_LINES'] = 5000
+app.config['PARSE_POOL_TIMEOUT'] = 60
+# Type database compiled from TYPES_JSON_PATH by tools/build_typedb.py. It is
+# compiled at startup too when missing or older than the JSON file.
+app.config['TYPES_JSON_PATH'] = 'data/types.json'
+app.config['TYPE_DB_PATH'] = os.environ.get("TYPE_DB_PATH", 'data/types.db')
+# Workers look for a new type database, compiled by tools/build_typedb.py,
+# at most once per TYPE_DB_CHECK_INTERVAL seconds and load it without a
+# restart. Sending TYPE_DB_RELOAD_SIGNAL (e.g. SIGUSR2) to a worker makes it
+# look on its next request. Pick a signal your server doesn't use itself.
+app.config['TYPE_DB_CHECK_INTERVAL'] = int(
+    os.environ.get("TYPE_DB_CHECK_INTERVAL", "60"))
+app.config['TYPE_DB_RELOAD_SIGNAL'] = os.environ.get(
+    "TYPE_DB_RELOAD_SIGNAL", "")
+# Background price warmer (tools/warm_prices.py). Every PRICE_WARMER_INTERVAL
+# seconds it refreshes the PRICE_WARMER_TOP_N most appraised types of each
+# market, found in the last PRICE_WARMER_SAMPLE appraisals, at no more than
+# PRICE_WARMER_RATE types per second. Cycles start often enough to finish
+# before the prices of the last one go stale, so users don't trigger
+# refreshes of the types the warmer looks after.
+app.config['PRICE_WARMER_INTERVAL'] = (
+    app.config['PRICE_CACHE_STALE_AFTER'] * 3 // 4)
+app.config['PRICE_WARMER_TOP_N'] = 500
+app.config['PRICE_WARMER_SAMPLE'] = 5000
+app.config['PRICE_WARMER_RATE'] = 20
 
 # no memcached support for windows, and we need to flip slashes. deal with it.
 if sys.platform == 'win32':
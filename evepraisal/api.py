@@ -8,7 +8,8 @@ from sqlalchemy import desc
 
 from evepraisal.estimate import create_appraisal
 from evepraisal.filters import get_market_name
-from evepraisal.helpers import login_required_if_config
+from evepraisal.helpers import (
+    get_requested_markets, login_required_if_config)
 from evepraisal.models import Appraisals
 from . import cache, g, session
 
@@ -35,7 +36,8 @@ def estimate_create(version):
     raw_paste = request.form.get('raw_paste', '')
     solar_system = request.form.get('market', '30000142')
 
-    appraisal = create_appraisal(raw_paste, solar_system)
+    appraisal = create_appraisal(raw_paste, solar_system,
+                                 markets=get_requested_markets())
 
     if no_redirect == "no":
         if return_format == "csv":
@@ -46,6 +48,16 @@ def estimate_create(version):
     return redirect(url_for(redirect_string, result_id=appraisal.Id), code=302)
 
 
+def market_totals(appraisal):
+    """ Lists the totals of every market a multi-market appraisal was
+        priced in.
+    """
+    return [{'market_id': int(market),
+             'market_name': get_market_name(market),
+             'totals': totals}
+            for market, totals in appraisal.market_totals()]
+
+
 def estimate_history(version, request_format='json'):
     """Provides a list of historical estimates for the current user.
     """
@@ -75,9 +87,12 @@ def estimate_history(version, request_format='json'):
             'market_name': get_market_name(appraisal.Market),
             'totals': appraisal.totals()
         }
+        if appraisal.MarketPrices and request_format != 'csv':
+            value['market_totals'] = market_totals(appraisal)
 
         if version < 2:
-            value['items'] = list(appraisal.iter_types())
+            value['items'] = [item.as_dict() for item in
+                              appraisal.iter_types()]
             request_format = 'json'
 
         if version > 1 and request_format == 'csv':
@@ -237,9 +252,11 @@ def estimate_json(result_id, version):
             'created': message.Created,
             'market_id': message.Market,
             'market_name': get_market_name(message.Market),
-            'items': list(message.iter_types()),
+            'items': [item.as_dict() for item in message.iter_types()],
             'totals': message.totals()
         }
+        if message.MarketPrices:
+            data['market_totals'] = market_totals(message)
         if version > 1:
             data_v2 = {
                 'raw': message.RawInput,
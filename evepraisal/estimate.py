@@ -1,13 +1,29 @@
+import Queue
+import os
+import threading
 import time
-import urllib2
 import uuid
-import xml.etree.ElementTree as ET
+from collections import OrderedDict, defaultdict
+from multiprocessing.pool import ThreadPool
 
-import evepaste
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
-from helpers import createsession
+import evepaste
+import numpy
+from flask import abort
+from werkzeug.contrib.cache import MemcachedCache
+
+import health
+import httpclient
+from helpers import (
+    createsession, incr_request_stat, get_request_stats, incr_shared_stat,
+    record_stage_stats, format_pricing_breakdown)
 from models import *
-from parser import parse
+from parser import PARSED_VERSION, PasteTooLarge, parse
+from pricestore import get_stored_values, store_values
 from . import app, cache, session, g
 
 
@@ -17,17 +33,169 @@ def memcache_type_key(typeId, options=None):
     return "prices:%s:%s" % (options.get('solarsystem_id', '-1'), typeId)
 
 
+def negative_type_key(typeId, options=None):
+    return "noprice:%s" % memcache_type_key(typeId, options=options)
+
+
+def warmed_types_key(options=None):
+    if options is None:
+        options = {}
+    return "warmer:types:%s" % options.get('solarsystem_id', '-1')
+
+
+def sends_keys_at_once():
+    """ Tells whether the cache backend sends many keys in a single call.
+        Others loop over them one by one.
+    """
+    return isinstance(cache.cache, MemcachedCache)
+
+
+def cache_get_many(keys):
+    """ Looks up several cache keys at once. Memcached answers with a single
+        round-trip. Returns the values in the same order as keys.
+    """
+    if not keys:
+        return []
+    values = cache.get_many(*keys)
+    if sends_keys_at_once():
+        incr_request_stat('cache_roundtrips_saved', len(keys) - 1)
+    return values
+
+
+def cache_set_many(mapping, timeout=None):
+    """ Stores several cache entries at once, in a single round-trip with
+        memcached.
+    """
+    if not mapping:
+        return
+    cache.set_many(mapping, timeout=timeout)
+    if sends_keys_at_once():
+        incr_request_stat('cache_roundtrips_saved', len(mapping) - 1)
+
+
+def cache_add_many(mapping, timeout=None):
+    """ Adds the entries of mapping whose keys aren't in the cache yet.
+        Returns the keys that were added. pylibmc adds them all in a single
+        round-trip, other backends one at a time.
+    """
+    if not mapping:
+        return []
+    client = getattr(cache.cache, '_client', None)
+    if sends_keys_at_once() and hasattr(client, 'add_multi'):
+        keys = dict((cache.cache._normalize_key(key), key) for key in mapping)
+        failed = set(client.add_multi(
+            dict((key, mapping[orig]) for key, orig in keys.items()),
+            cache.cache._normalize_timeout(timeout)))
+        incr_request_stat('cache_roundtrips_saved', len(mapping) - 1)
+        return [orig for key, orig in keys.items() if key not in failed]
+    return [key for key, value in mapping.items()
+            if cache.cache.add(key, value, timeout=timeout)]
+
+
 def get_cached_values(eve_types, options=None):
-    "Get Cached values given the eve_types"
+    """ Get Cached values given the eve_types. Values looked up beforehand
+        can be passed as options['prefetched'], a tuple of
+        ({typeId: cached value or None}, warmed types).
+    """
+    if options and options.get('refresh'):
+        return {}
+
+    prefetched = options.get('prefetched') if options else None
+    if prefetched:
+        cached, warmed_types = prefetched
+    else:
+        cached, warmed_types = {}, None
+    lookup = [eve_type for eve_type in eve_types if eve_type not in cached]
+    if lookup:
+        keys = [memcache_type_key(eve_type, options=options)
+                for eve_type in lookup]
+        # The set of types kept warm by the price warmer rides along in the
+        # same lookup so its share of the hits can be counted.
+        values = cache_get_many(keys + [warmed_types_key(options=options)])
+        warmed_types = values.pop()
+        cached = dict(cached)
+        cached.update(zip(lookup, values))
+
     found = {}
+    warmed_hits = 0
     for eve_type in eve_types:
-        key = memcache_type_key(eve_type, options=options)
-        obj = cache.get(key)
+        obj = cached.get(eve_type)
         if obj:
             found[eve_type] = obj
+            if warmed_types and eve_type in warmed_types:
+                warmed_hits += 1
+
+    if warmed_types is not None and found:
+        incr_shared_stat('price_cache_hits', len(found))
+        if warmed_hits:
+            incr_shared_stat('price_cache_warmed_hits', warmed_hits)
     return found
 
 
+def get_negative_values(eve_types, options=None):
+    """ Returns {typeId: None} for the types no provider could price
+        recently, so the providers aren't asked for them again until their
+        entry expires. Types that were only found without volume come back
+        with that zero-price entry instead.
+    """
+    if options and options.get('refresh'):
+        return {}
+
+    values = cache_get_many([negative_type_key(eve_type, options=options)
+                             for eve_type in eve_types])
+    found = dict((eve_type, value if isinstance(value, dict) else None)
+                 for eve_type, value in zip(eve_types, values) if value)
+    if found:
+        incr_request_stat('negative_cache_hits', len(found))
+        incr_shared_stat('negative_cache_hits', len(found))
+    return found
+
+
+def iter_marketstat_types(stream, solarsystem_id):
+    """ Incrementally parses an eve-central marketstat document from a file
+        like object, yielding (typeId, pricing details) as each <type>
+        element is completed. Consumed elements are cleared so the whole
+        document tree is never held in memory.
+    """
+    all_price_metric = 'percentile'
+    if solarsystem_id == '-1':
+        buy_price_metric = 'percentile'
+        sell_price_metric = 'percentile'
+    else:
+        buy_price_metric = 'max'
+        sell_price_metric = 'min'
+
+    for _, elem in ET.iterparse(stream):
+        if elem.tag != 'type':
+            continue
+
+        k = int(elem.attrib.get('id'))
+        v = {}
+        for stat_type in ['sell', 'buy', 'all']:
+            props = {}
+            for stat in elem.find(stat_type):
+                if not stat.tag == "generated":
+                    props[stat.tag] = float(stat.text)
+            v[stat_type] = props
+        v['all']['price'] = v['all'][all_price_metric]
+        v['buy']['price'] = v['buy'][buy_price_metric]
+        v['sell']['price'] = v['sell'][sell_price_metric]
+        v['source'] = 'evecentral'
+
+        # Only an empty shell of the <type> element is left behind
+        elem.clear()
+        yield k, v
+
+
+def report_failed(eve_types, options):
+    """ Adds eve_types to options['failed'], when given, the set of types a
+        provider couldn't fetch. Those can't be taken as having no price.
+    """
+    failed = options.get('failed')
+    if failed is not None:
+        failed.update(eve_types)
+
+
 def get_market_values(eve_types, options=None):
     """
         Takes list of typeIds. Returns dict of pricing details with typeId as
@@ -64,43 +232,26 @@ def get_market_values(eve_types, options=None):
 
     market_prices = {}
     solarsystem_id = options.get('solarsystem_id', -1)
-    for types in [eve_types[i:i + 100] for i in range(0, len(eve_types), 100)]:
+    batches = [eve_types[i:i + 100] for i in range(0, len(eve_types), 100)]
+    errors = []
+    for types in batches:
         query = []
         query += ['typeid=%s' % str(type_id) for type_id in types]
-        all_price_metric = 'percentile'
-        if solarsystem_id == '-1':
-            buy_price_metric = 'percentile'
-            sell_price_metric = 'percentile'
-        else:
-            buy_price_metric = 'max'
-            sell_price_metric = 'min'
+        if solarsystem_id != '-1':
             query += ['usesystem=%s' % solarsystem_id]
         query_str = '&'.join(query)
         url = "http://api.eve-central.com/api/marketstat?%s" % query_str
         app.logger.debug("API Call: %s", url)
         try:
-            request = urllib2.Request(url)
-            request.add_header('User-Agent', app.config['USER_AGENT'])
-            response = urllib2.build_opener().open(request).read()
-            stats = ET.fromstring(response).findall("./marketstat/type")
-
-            for marketstat in stats:
-                k = int(marketstat.attrib.get('id'))
-                v = {}
-                for stat_type in ['sell', 'buy', 'all']:
-                    props = {}
-                    for stat in marketstat.find(stat_type):
-                        if not stat.tag == "generated":
-                            props[stat.tag] = float(stat.text)
-                    v[stat_type] = props
-                v['all']['price'] = v['all'][all_price_metric]
-                v['buy']['price'] = v['buy'][buy_price_metric]
-                v['sell']['price'] = v['sell'][sell_price_metric]
-                v['source'] = 'evecentral'
-                market_prices[k] = v
-
-        except urllib2.HTTPError:
-            pass
+            with httpclient.stream(url) as response:
+                for k, v in iter_marketstat_types(response, solarsystem_id):
+                    market_prices[k] = v
+
+        except httpclient.HTTPError as e:
+            errors.append(e)
+            if health.is_outage(e):
+                report_failed(types, options)
+    health.record_call('evecentral', len(batches), errors)
     #: Debugging Market_Prices
     #:
     #: f = open('C:\open.txt', 'w')
@@ -144,7 +295,9 @@ def get_market_values_evemarketdata(eve_types, options=None):
 
     market_prices = {}
     solarsystem_id = options.get('solarsystem_id', '-1')
-    for types in [eve_types[i:i + 200] for i in range(0, len(eve_types), 200)]:
+    batches = [eve_types[i:i + 200] for i in range(0, len(eve_types), 200)]
+    errors = []
+    for types in batches:
         typeIds_str = 'type_ids=%s' % ','.join(str(type_id) for type_id in types)
         query = [typeIds_str]
 
@@ -160,9 +313,7 @@ def get_market_values_evemarketdata(eve_types, options=None):
               "char_name=magerawr&buysell=a&%s" % (query_str)
         app.logger.debug("API Call: %s", url)
         try:
-            request = urllib2.Request(url)
-            request.add_header('User-Agent', app.config['USER_AGENT'])
-            response = json.loads(urllib2.build_opener().open(request).read())
+            response = json.loads(httpclient.fetch(url))
 
             for row in response['emd']['result']:
                 row = row['row']
@@ -192,67 +343,247 @@ def get_market_values_evemarketdata(eve_types, options=None):
                     market_prices[typeId]['sell']['min']
                 market_prices[typeId]['source'] = 'evemarketdata'
 
-        except urllib2.HTTPError:
-            pass
+        except httpclient.HTTPError as e:
+            errors.append(e)
+            if health.is_outage(e):
+                report_failed(types, options)
         except ValueError:
-            pass
+            report_failed(types, options)
+    health.record_call('evemarketdata', len(batches), errors)
     return market_prices
 
 
+def batch_price_volume_statistics(keys, prices, volumes):
+    """ Calculates the statistics of price_volume_statistics for many order
+        books in one pass. Takes three equally long columns: the key of the
+        order book each order belongs to (an integer), its price and its
+        volume. Returns a dict of statistics keyed by order book.
+    """
+    keys = numpy.asarray(keys)
+    prices = numpy.asarray(prices, dtype=float)
+    volumes = numpy.asarray(volumes)
+    if len(keys) == 0:
+        return {}
+
+    # Sort by order book, then by price within each book. Two stable sorts
+    # are quicker than numpy.lexsort here.
+    order = numpy.argsort(prices, kind='mergesort')
+    order = order[numpy.argsort(keys[order], kind='mergesort')]
+    keys = keys[order]
+    prices = prices[order]
+    volumes = volumes[order]
+
+    starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+    sizes = numpy.diff(numpy.r_[starts, len(keys)])
+
+    # Summed in the input's own type, so integer volumes stay integers
+    total_volume = numpy.add.reduceat(volumes, starts)
+
+    # Cumulative volume within each book, up to and including every order
+    volumes = volumes.astype(float)
+    cumulative = numpy.cumsum(volumes)
+    cumulative -= numpy.repeat(cumulative[starts] - volumes[starts], sizes)
+    five_pct_volume = numpy.repeat(total_volume * 0.05, sizes)
+    top_threshold = numpy.repeat(total_volume, sizes) - five_pct_volume
+
+    # The share of each order that falls in the cheapest and the most
+    # expensive 5% of the book's volume
+    bottom_volume = numpy.minimum(volumes,
+                                  five_pct_volume - (cumulative - volumes))
+    top_volume = numpy.minimum(volumes, cumulative - top_threshold)
+
+    total_price = numpy.add.reduceat(prices * volumes, starts)
+    bottom5pct = numpy.add.reduceat(
+        prices * numpy.clip(bottom_volume, 0, None), starts)
+    top5pct = numpy.add.reduceat(
+        prices * numpy.clip(top_volume, 0, None), starts)
+    ends = starts + sizes - 1
+
+    results = {}
+    for i, start in enumerate(starts):
+        totalvolume = total_volume[i].item()
+        fivepctvolume = totalvolume * 0.05
+        results[keys[start].item()] = {
+            "avg": float(total_price[i]) / totalvolume,
+            "max": float(prices[ends[i]]),
+            "min": float(prices[start]),
+            "bottom5pct": float(bottom5pct[i]) / fivepctvolume,
+            "top5pct": float(top5pct[i]) / fivepctvolume,
+            "volume": totalvolume
+        }
+    return results
+
+
 def price_volume_statistics(pricevolumedict):
     """ Calculates pricing statistics given a list of dicts
         containing { "price": price, "volume": volume }
     """
-    pricevolumedict = sorted(pricevolumedict, key=lambda k: k['price'])
     if len(pricevolumedict) == 0:
         return {'avg': 0, 'max': 0, 'min': 0, 'bottom5pct': 0, 'top5pct': 0, 'volume': 0}
 
-    maxprice = pricevolumedict[0]['price']
-    minprice = pricevolumedict[0]['price']
-    totalvolume = 0
-    totalprice = 0
-
-    for item in pricevolumedict:
-        totalvolume += item['volume']
-        totalprice += (item['price'] * item['volume'])
-        minprice = min(minprice, item['price'])
-        maxprice = max(maxprice, item['price'])
-
-    fivepctvolume = totalvolume * 0.05
-    currentvolume = 0.00
-    top5pct = 0.00
-    bottom5pct = 0.00
-    volumetouse = 0.00
-
-    for item in pricevolumedict:
-        if currentvolume < fivepctvolume:
-            if (currentvolume + item['volume']) <= fivepctvolume:
-                volumetouse = item['volume']
-            else:
-                volumetouse = fivepctvolume - currentvolume
-            bottom5pct += (item['price'] * volumetouse)
+    return batch_price_volume_statistics(
+        [0] * len(pricevolumedict),
+        [item['price'] for item in pricevolumedict],
+        [item['volume'] for item in pricevolumedict])[0]
 
-        if (currentvolume + item['volume']) > (totalvolume - fivepctvolume):
-            if currentvolume > (totalvolume - fivepctvolume):
-                volumetouse = item['volume']
-            else:
-                volumetouse = ((currentvolume + item['volume']) - (totalvolume - fivepctvolume))
-            top5pct += (item['price'] * volumetouse)
 
-        currentvolume = currentvolume + item['volume']
+def get_crest_type_orders(region, type_id):
+    """ Fetches the order book for a single type in a region from EVE CREST.
+        Raises httpclient.HTTPError if CREST can't be reached or returns an
+        error.
+    """
+    url = "%s/market/%s/orders/?type=%s/inventory/types/%s/" % (
+        app.config['CREST_URL'], region, app.config['CREST_URL'], type_id)
+    app.logger.debug("API Call: %s", url)
+    return json.loads(httpclient.fetch(url))["items"]
+
+
+#: Order book sides, used to tell the books of one type apart when their
+#: statistics are calculated together
+CREST_SIDES = ['all', 'buy', 'sell']
+
+
+def summarize_crest_orders(orders_by_type):
+    """ Takes {typeId: [CREST order, ...]} and returns pricing details for
+        every type, calculating the statistics of all of the order books in
+        a single batched call.
+    """
+    type_ids = []
+    buys = []
+    prices = []
+    volumes = []
+    for type_id, orders in orders_by_type.items():
+        type_ids += [type_id] * len(orders)
+        buys += [item["buy"] for item in orders]
+        prices += [item["price"] for item in orders]
+        volumes += [item["volume"] for item in orders]
+
+    # Every order is counted in the 'all' book and in its buy or sell book
+    all_keys = numpy.array(type_ids, dtype=numpy.int64) * 3
+    side_keys = all_keys + numpy.where(buys, 1, 2)
+    statistics = batch_price_volume_statistics(
+        numpy.concatenate([all_keys, side_keys]),
+        prices + prices,
+        volumes + volumes)
+    empty = price_volume_statistics([])
+
+    market_prices = {}
+    for type_id in orders_by_type:
+        output = {"source": "crest"}
+        for i, side in enumerate(CREST_SIDES):
+            stats = statistics.get(type_id * 3 + i, empty)
+            output[side] = {"avg": stats['avg'], "max": stats['max'],
+                            "min": stats['min'], "volume": stats['volume']}
+
+        output["all"]["price"] = output["all"]['avg']
+        output["buy"]["price"] = statistics.get(type_id * 3 + 1, empty)['top5pct']
+        output["sell"]["price"] = statistics.get(type_id * 3 + 2, empty)['bottom5pct']
+        market_prices[type_id] = output
+    return market_prices
+
+
+CREST_REGIONS = {
+    "30000142": "10000002",  # JITA
+    "30002187": "10000043",  # AMARR
+    "30002659": "10000032",  # DODIXIE
+    "30002510": "10000030",  # RENS
+    "30002053": "10000042",  # HEK
+}
+
 
-    avg = totalprice / totalvolume
-    bottom5pct = bottom5pct / fivepctvolume
-    top5pct = top5pct / fivepctvolume
+def get_crest_region(solarsystem_id):
+    return CREST_REGIONS.get(solarsystem_id, CREST_REGIONS["30000142"])
 
-    return {
-        "avg": avg,
-        "max": maxprice,
-        "min": minprice,
-        "bottom5pct": bottom5pct,
-        "top5pct": top5pct,
-        "volume": totalvolume
-    }
+
+def crest_region_key(region):
+    return "crest:region:%s" % region
+
+
+def get_crest_region_orders(region):
+    """ Fetches every order in a region from EVE CREST, page by page, and
+        returns them grouped as {typeId: [CREST order, ...]}.
+    """
+    url = "%s/market/%s/orders/all/" % (app.config['CREST_URL'], region)
+    app.logger.debug("API Call: %s", url)
+    first_page = json.loads(httpclient.fetch(url))
+    pages = [first_page]
+
+    def fetch(page):
+        page_url = "%s?page=%s" % (url, page)
+        app.logger.debug("API Call: %s", page_url)
+        return json.loads(httpclient.fetch(page_url))
+
+    page_numbers = range(2, first_page.get("pageCount", 1) + 1)
+    if page_numbers:
+        pool = ThreadPool(min(app.config['CREST_MAX_IN_FLIGHT'],
+                              len(page_numbers)))
+        try:
+            pages += pool.map(fetch, page_numbers)
+        finally:
+            pool.close()
+            pool.join()
+
+    orders_by_type = defaultdict(list)
+    for page in pages:
+        for item in page["items"]:
+            orders_by_type[item["type"]].append(item)
+    return orders_by_type
+
+
+def refresh_crest_region(region):
+    """ Ingests the complete order book of a region and fills the price
+        cache and store for every type traded there, for each market that
+        is priced from that region. Returns the number of types priced.
+    """
+    market_prices = summarize_crest_orders(get_crest_region_orders(region))
+    now = int(time.time())
+    for pricing_info in market_prices.values():
+        pricing_info['priced_at'] = now
+    for solarsystem_id in app.config['VALID_SOLAR_SYSTEMS']:
+        if get_crest_region(solarsystem_id) != region:
+            continue
+        options = {'solarsystem_id': solarsystem_id}
+        type_ids = list(market_prices)
+        for i in range(0, len(type_ids), 1000):
+            cache_set_many(
+                dict((memcache_type_key(type_id, options=options),
+                      market_prices[type_id])
+                     for type_id in type_ids[i:i + 1000]),
+                timeout=app.config['PRICE_CACHE_TIMEOUT'])
+        store_values(market_prices, options=options)
+
+    cache.set(crest_region_key(region), int(time.time()),
+              timeout=app.config['CREST_REGION_REFRESH_INTERVAL'])
+    app.logger.info("Ingested CREST orders for %s types in region %s",
+                    len(market_prices), region)
+    return len(market_prices)
+
+
+def schedule_crest_region_refresh(region):
+    """ Refreshes a region's order book on a background thread, unless a
+        worker is already doing so.
+    """
+    lock_key = crest_region_key(region) + ":lock"
+    if not cache.cache.add(lock_key, True, timeout=10 * 60):
+        return
+
+    def refresh():
+        with app.app_context():
+            try:
+                refresh_crest_region(region)
+                health.record_success('crest')
+            except httpclient.HTTPError as e:
+                app.logger.warning("Could not ingest region %s: %s",
+                                   region, e)
+                health.record_call('crest', 1, [e])
+            except Exception:
+                app.logger.exception("Could not ingest region %s", region)
+            finally:
+                cache.delete(lock_key)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
 
 
 def get_market_values_crest(eve_types, options=None):
@@ -260,7 +591,11 @@ def get_market_values_crest(eve_types, options=None):
         the key. Calls out to EVE CREST.
 
         This will do an entire region, and will default to The Forge(JITA) if
-        the region is not specified in the dictionary below.
+        the region is not specified in CREST_REGIONS.
+
+        CREST only serves one type per request, so up to CREST_MAX_IN_FLIGHT
+        order books are fetched at the same time. Their statistics are then
+        calculated together.
     """
     if len(eve_types) == 0:
         return {}
@@ -268,68 +603,42 @@ def get_market_values_crest(eve_types, options=None):
     if options is None:
         options = {}
 
-    market_prices = {}
+    region = get_crest_region(options.get('solarsystem_id', '-1'))
 
-    regions = {
-        "30000142": "10000002",  # JITA
-        "30002187": "10000043",  # AMARR
-        "30002659": "10000032",  # DODIXIE
-        "30002510": "10000030",  # RENS
-        "30002053": "10000042",  # HEK
-    }
+    if app.config['CREST_REGION_BULK']:
+        if cache.get(crest_region_key(region)):
+            # The whole order book of the region was ingested recently, so
+            # anything that isn't cached has no orders there.
+            return {}
+        schedule_crest_region_refresh(region)
 
-    solarsystem_id = options.get('solarsystem_id', '-1')
+    errors = []
 
-    if solarsystem_id not in regions:
-        solarsystem_id = "30000142"
-
-    region = regions[solarsystem_id]
-
-    for types in [eve_types[i:i + 200] for i in range(0, len(eve_types), 200)]:
-        for type_id in types:
-            url = "https://crest-tq.eveonline.com/market/%s/orders/?type=https://crest-tq.eveonline.com/inventory/types/%s/" % (
-                region, type_id)
-            app.logger.debug("API Call: %s", url)
-            try:
-                request = urllib2.Request(url)
-                request.add_header('User-Agent', app.config['USER_AGENT'])
-                response = json.loads(urllib2.build_opener().open(request).read())
-                buy = []
-                sell = []
-                all = []
-
-                i = 0
-                for item in response["items"]:
-                    i = i + 1
-                    if item["buy"]:
-                        buy.append({"i": i, "volume": item["volume"], "price": item["price"]})
-                    else:
-                        sell.append({"i": i, "volume": item["volume"], "price": item["price"]})
-
-                    all.append({"i": i, "volume": item["volume"], "price": item["price"]})
-
-                output_all = price_volume_statistics(all)
-                output_buy = price_volume_statistics(buy)
-                output_sell = price_volume_statistics(sell)
-
-                output = {
-                    "all": {"avg": output_all['avg'], "max": output_all['max'], "min": output_all['min'],
-                            "volume": output_all['volume']},
-                    "buy": {"avg": output_buy['avg'], "max": output_buy['max'], "min": output_buy['min'],
-                            "volume": output_buy['volume']},
-                    "sell": {"avg": output_sell['avg'], "max": output_sell['max'], "min": output_sell['min'],
-                             "volume": output_sell['volume']},
-                    "source": "crest"
-                }
-
-                output["all"]["price"] = output_all['avg']
-                output["buy"]["price"] = output_buy['top5pct']
-                output["sell"]["price"] = output_sell['bottom5pct']
-
-                market_prices[type_id] = output
-
-            except urllib2.HTTPError:
-                pass
+    def fetch(type_id):
+        try:
+            return get_crest_type_orders(region, type_id)
+        except httpclient.HTTPError as e:
+            errors.append(e)
+            # A 404 is CREST not knowing the type, not a failed fetch
+            if health.is_outage(e):
+                report_failed([type_id], options)
+
+    max_in_flight = min(app.config['CREST_MAX_IN_FLIGHT'], len(eve_types))
+    if max_in_flight > 1:
+        pool = ThreadPool(max_in_flight)
+        try:
+            results = pool.map(fetch, eve_types)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [fetch(type_id) for type_id in eve_types]
+
+    orders_by_type = dict((type_id, orders)
+                          for type_id, orders in zip(eve_types, results)
+                          if orders is not None)
+    market_prices = summarize_crest_orders(orders_by_type)
+    health.record_call('crest', len(eve_types), errors)
     #: Debugging market_prices
     #: f = open('C:\open.txt', 'w')
     #: f.write(str(market_prices))
@@ -352,71 +661,430 @@ def get_invalid_values(eve_types, options=None):
     return invalid_items
 
 
+def get_components(eve_type):
+    """ Returns {component typeId: quantity} for a type built from
+        components, or None.
+    """
+    type_details = get_type_by_id(eve_type)
+    if type_details and 'components' in type_details:
+        return dict((c['materialTypeID'], c['quantity'])
+                    for c in type_details['components'])
+
+
 def get_componentized_values(eve_types, options=None):
+    """ Prices types built from components, like capital ships, as the sum
+        of their components. Components can be built from components
+        themselves; the plain components found anywhere below the requested
+        types are priced together in a single call. The sums are remembered
+        per market for the rest of the request, except when refreshing.
+    """
+    if options is None:
+        options = {}
+    market = options.get('solarsystem_id', '-1')
+    if options.get('refresh'):
+        # A refresh has to sum up the component prices it just fetched
+        memo = {}
+    else:
+        memo = g.setdefault('component_prices', {})
+
+    # Walk down to the components that have to be priced on the market
+    components = {}
+    for eve_type in eve_types:
+        if (market, eve_type) not in memo:
+            components[eve_type] = get_components(eve_type)
+    leaves = set()
+    to_visit = [c for eve_type, parts in components.items() if parts
+                for c in parts if (market, c) not in memo]
+    while to_visit:
+        eve_type = to_visit.pop()
+        if eve_type in leaves or components.get(eve_type) is not None:
+            continue
+        components[eve_type] = get_components(eve_type)
+        if components[eve_type] is None:
+            leaves.add(eve_type)
+            continue
+        to_visit.extend(c for c in components[eve_type]
+                        if (market, c) not in memo)
+
+    price_map = {}
+    if leaves:
+        price_map = dict(get_market_prices(list(leaves), options=options))
+
+    zeroed_price = {'avg': 0, 'min': 0, 'max': 0, 'price': 0}
+
+    def componentized_price(eve_type):
+        if (market, eve_type) in memo:
+            return memo[(market, eve_type)]
+        complete_price_data = {
+            'buy': zeroed_price.copy(),
+            'sell': zeroed_price.copy(),
+            'all': zeroed_price.copy(),
+        }
+        # Guards against a type that (indirectly) contains itself
+        memo[(market, eve_type)] = complete_price_data
+        for component, quantity in components[eve_type].items():
+            if components.get(component) is not None or (market, component) in memo:
+                _price = componentized_price(component)
+            else:
+                _price = price_map.get(component)
+            if not _price:
+                continue
+            for market_type in ['buy', 'sell', 'all']:
+                for stat in ['avg', 'min', 'max', 'price']:
+                    complete_price_data[market_type][stat] += (
+                        _price[market_type][stat] * quantity)
+        return complete_price_data
+
     componentized_items = {}
     for eve_type in eve_types:
-        type_details = get_type_by_id(eve_type)
-        if type_details and 'components' in type_details:
-            component_types = dict((c['materialTypeID'], c['quantity'])
-                                   for c in type_details['components'])
+        if (market, eve_type) in memo or components.get(eve_type) is not None:
+            componentized_items[eve_type] = componentized_price(eve_type)
+    return componentized_items
 
-            component_prices = get_market_prices(component_types.keys(),
-                                                 options=options)
-            price_map = dict(component_prices)
-            zeroed_price = {'avg': 0, 'min': 0, 'max': 0, 'price': 0}
-            complete_price_data = {
-                'buy': zeroed_price.copy(),
-                'sell': zeroed_price.copy(),
-                'all': zeroed_price.copy(),
-            }
-            for component, quantity in component_types.items():
-                for market_type in ['buy', 'sell', 'all']:
-                    for stat in ['avg', 'min', 'max', 'price']:
-                        _price = price_map.get(component)
-                        if _price:
-                            complete_price_data[market_type][stat] += (
-                                _price[market_type][stat] * quantity)
-            componentized_items[eve_type] = complete_price_data
 
-    return componentized_items
+#: The pricing pipeline as (name, pricing method) in the order the stages
+#: are tried. Each stage only gets the types no earlier stage could price.
+PRICING_STAGES = [
+    ('invalid', get_invalid_values),
+    ('cached', get_cached_values),
+    ('stored', get_stored_values),
+    ('negative', get_negative_values),
+    ('componentized', get_componentized_values),
+    ('crest', get_market_values_crest),
+    ('evecentral', get_market_values),
+    ('evemarketdata', get_market_values_evemarketdata),
+]
+
+#: Stages that serve prices which are already cached and stored. A stage
+#: can answer None for a type to say it is known to have no price.
+LOCAL_STAGES = frozenset(['invalid', 'cached', 'stored', 'negative'])
+
+#: Stages that call out to a remote provider. Their health is tracked under
+#: the stage name.
+PROVIDERS = frozenset(['crest', 'evecentral', 'evemarketdata'])
+
+
+def _call_provider(stage, eve_types, options, results):
+    name, pricing_method = stage
+    with app.app_context():
+        try:
+            _prices = pricing_method(eve_types, options=options)
+        except Exception:
+            app.logger.exception("Pricing stage %s failed", name)
+            report_failed(eve_types, options)
+            _prices = {}
+    results.put((name, _prices))
+
+
+def has_price(pricing_info):
+    return (pricing_info['buy']['price'] > 0 or
+            pricing_info['sell']['price'] > 0 or
+            pricing_info['all']['price'] > 0)
+
+
+def get_hedged_prices(primary, secondary, eve_types, options=None):
+    """ Calls the primary provider stage and, if it hasn't answered within
+        PROVIDER_HEDGE_AFTER seconds, the secondary one as well. Returns
+        [(stage name, prices), ...] in the order the answers came in. The
+        slower answer is only waited for when the first one left types
+        without a price, otherwise it is left to finish in the background.
+    """
+    results = Queue.Queue()
+
+    def start(stage):
+        thread = threading.Thread(target=_call_provider,
+                                  args=(stage, list(eve_types),
+                                        options, results))
+        thread.daemon = True
+        thread.start()
+
+    start(primary)
+    try:
+        return [results.get(timeout=app.config['PROVIDER_HEDGE_AFTER'])]
+    except Queue.Empty:
+        pass
+
+    app.logger.debug("%s is slow, hedging with %s", primary[0], secondary[0])
+    incr_request_stat('hedged_requests')
+    start(secondary)
+    answers = [results.get()]
+    _prices = answers[0][1]
+    if any(not _prices.get(eve_type) or not has_price(_prices[eve_type])
+           for eve_type in eve_types):
+        # The other provider is asked about those types already, wait for it
+        # rather than asking the next one
+        answers.append(results.get())
+    return answers
+
+
+#: Types being fetched from the providers by a request in this process,
+#: keyed by (market, typeId)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def price_lock_key(typeId, options=None):
+    return "lock:%s" % memcache_type_key(typeId, options=options)
+
+
+def claim_price_fetches(eve_types, options=None):
+    """ Claims the right to fetch eve_types from the providers, so that
+        concurrent requests missing the same prices wait for this one instead
+        of calling the providers themselves. Claims are taken in-process
+        first, then in the cache so they hold across workers.
+
+        Returns (claimed, pending): the types this request must fetch and
+        the types somebody else is already fetching.
+    """
+    market = options.get('solarsystem_id', '-1')
+    local = []
+    pending = []
+    with _inflight_lock:
+        for type_id in eve_types:
+            if (market, type_id) in _inflight:
+                pending.append(type_id)
+            else:
+                _inflight[(market, type_id)] = threading.Event()
+                local.append(type_id)
+
+    keys = dict((type_id, price_lock_key(type_id, options=options))
+                for type_id in local)
+    added = set(cache_add_many(
+        dict((key, True) for key in keys.values()),
+        timeout=app.config['PRICE_COALESCE_TIMEOUT']))
+    claimed = [type_id for type_id in local if keys[type_id] in added]
+    taken_elsewhere = [type_id for type_id in local
+                       if keys[type_id] not in added]
+    if taken_elsewhere:
+        # Another worker has them, let our threads watch the cache as well
+        release_price_fetches(taken_elsewhere, options=options, locked=False)
+        pending.extend(taken_elsewhere)
+    return claimed, pending
+
+
+def release_price_fetches(eve_types, options=None, locked=True):
+    """ Releases claims taken by claim_price_fetches, waking up requests
+        waiting on them.
+    """
+    market = options.get('solarsystem_id', '-1')
+    if locked and eve_types:
+        cache.delete_many(*[price_lock_key(type_id, options=options)
+                            for type_id in eve_types])
+    with _inflight_lock:
+        for type_id in eve_types:
+            event = _inflight.pop((market, type_id), None)
+            if event is not None:
+                event.set()
+
+
+def wait_for_price_fetches(eve_types, options=None):
+    """ Waits for the requests fetching eve_types to finish and returns the
+        prices they cached. Gives up after PRICE_COALESCE_TIMEOUT seconds.
+    """
+    market = options.get('solarsystem_id', '-1')
+    deadline = time.time() + app.config['PRICE_COALESCE_TIMEOUT']
+    with _inflight_lock:
+        events = [_inflight.get((market, type_id)) for type_id in eve_types]
+    for event in events:
+        if event is not None:
+            event.wait(max(0, deadline - time.time()))
+
+    price_keys = [memcache_type_key(type_id, options=options)
+                  for type_id in eve_types]
+    lock_keys = [price_lock_key(type_id, options=options)
+                 for type_id in eve_types]
+    while True:
+        values = cache_get_many(price_keys + lock_keys)
+        found = {}
+        still_locked = False
+        for type_id, price, lock in zip(eve_types, values, values[len(eve_types):]):
+            if price:
+                found[type_id] = price
+            elif lock:
+                still_locked = True
+
+        if not still_locked or time.time() >= deadline:
+            return found
+        time.sleep(0.05)
+
+
+def is_stale(pricing_info):
+    """ Tells whether a cached price is past PRICE_CACHE_STALE_AFTER. Prices
+        cached without a priced_at timestamp are of unknown age, so they are
+        treated as stale too.
+    """
+    priced_at = pricing_info.get('priced_at')
+    return (priced_at is None or
+            time.time() - priced_at > app.config['PRICE_CACHE_STALE_AFTER'])
+
+
+def price_refresh_key(typeId, options=None):
+    return "refresh:%s" % memcache_type_key(typeId, options=options)
+
+
+def schedule_price_refresh(eve_types, options=None):
+    """ Re-fetches stale prices on a background thread. A type is refreshed
+        by one worker at a time, and at most every five minutes, so a
+        provider that keeps failing isn't asked again on every request.
+    """
+    keys = dict((type_id, price_refresh_key(type_id, options=options))
+                for type_id in eve_types)
+    added = set(cache_add_many(dict((key, True) for key in keys.values()),
+                               timeout=5 * 60))
+    claimed = [type_id for type_id in eve_types if keys[type_id] in added]
+    if not claimed:
+        return
+    refresh_options = dict(options or {}, refresh=True)
+
+    def refresh():
+        with app.app_context():
+            try:
+                get_market_prices(claimed, options=refresh_options)
+            except Exception:
+                app.logger.exception("Could not refresh stale prices")
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
 
 
 def get_market_prices(modules, options=None):
-    unpriced_modules = modules[:]
+    """ Prices the typeIds in modules by running them through PRICING_STAGES
+        until every type has a price. Returns [(typeId, pricing_info), ...].
+    """
+    if options is None:
+        options = {}
+    coalesce = app.config['PRICE_COALESCE'] and options.get('coalesce', True)
+    claim = None
+    unpriced = set(modules)
     nmv = {}
     prices = {}
-    for pricing_method in [get_invalid_values,
-                           get_cached_values,
-                           get_componentized_values,
-                           get_market_values_crest,
-                           get_market_values,
-                           get_market_values_evemarketdata
-                           ]:
-        if len(modules) == len(prices):
-            break
-        # each pricing_method returns a dict with {type_id: pricing_info}
-        _prices = pricing_method(unpriced_modules, options=options)
-        app.logger.debug("Found %s/%s items using method: %s",
-                         len(_prices), len(modules), pricing_method)
-        for type_id, pricing_info in _prices.items():
-            if type_id in unpriced_modules:
-                # We only care if there is a non-zero price. If the price is 0, keep going.
-                if pricing_info['buy']['price'] > 0 or pricing_info['sell']['price'] > 0 or pricing_info['all'][
-                        'price'] > 0:
-                    if pricing_method not in [get_invalid_values, get_cached_values]:
-                        # And only cache things which come from an actual provider.
-                        cache.set(memcache_type_key(type_id, options=options), pricing_info, timeout=10 * 60 * 60)
-                    prices[type_id] = pricing_info
-                    unpriced_modules.remove(type_id)
-                    if type_id in nmv:
-                        del nmv[type_id]
-                elif pricing_info['buy']['price'] == 0 and type_id not in nmv:
-                    # If we get a match with no volume, we hold on to it to see if we find one that does.
-                    # If we won't, we'll use this info.
-                    nmv[type_id] = pricing_info
+    to_cache = {}
+    to_store = {}
+    stale = []
+    done = set()
+    # Whether every provider got asked about every type left unpriced
+    providers_complete = True
+    # Types a provider failed to fetch, they may well have a price
+    failed = set()
+    provider_options = dict(options, failed=failed)
+    try:
+        for i, (stage, pricing_method) in enumerate(PRICING_STAGES):
+            if not unpriced:
+                break
+            if stage in done:
+                continue
+
+            if stage in PROVIDERS and coalesce and claim is None:
+                # Whatever is still unpriced is about to go to the providers.
+                # Leave the types another request is already fetching to it.
+                claim = claim_price_fetches(list(unpriced), options=options)
+                unpriced.difference_update(claim[1])
+                if not unpriced:
+                    break
+
+            if stage in PROVIDERS and not health.is_available(stage):
+                app.logger.debug("Skipping %s while its circuit is open", stage)
+                incr_request_stat('providers_skipped')
+                providers_complete = False
+                continue
+
+            hedge = None
+            if stage in PROVIDERS and app.config['PROVIDER_HEDGE_AFTER'] > 0:
+                for candidate in PRICING_STAGES[i + 1:]:
+                    if (candidate[0] in PROVIDERS and
+                            health.is_available(candidate[0])):
+                        hedge = candidate
+                        break
+
+            started = time.time()
+            # each pricing_method returns a dict with {type_id: pricing_info}
+            if hedge:
+                answers = get_hedged_prices(
+                    (stage, pricing_method), hedge, list(unpriced),
+                    options=provider_options)
+                # A provider that answered isn't asked again further down
+                done.update(name for name, _prices in answers)
+            elif stage in PROVIDERS:
+                answers = [(stage, pricing_method(list(unpriced),
+                                                  options=provider_options))]
             else:
-                app.logger.debug("[Method: %s] A price was returned which "
-                                 "wasn't asked for", pricing_method)
+                answers = [(stage, pricing_method(list(unpriced),
+                                                  options=options))]
+
+            for stage, _prices in answers:
+                resolved = 0
+                cache_writes = 0
+                for type_id, pricing_info in _prices.items():
+                    if type_id not in unpriced:
+                        app.logger.debug("[Stage: %s] A price was returned which "
+                                         "wasn't asked for", stage)
+                        continue
+                    if pricing_info is None:
+                        unpriced.discard(type_id)
+                        resolved += 1
+                        continue
+                    if stage == 'negative':
+                        # Only found without volume last time, serve that again
+                        nmv[type_id] = pricing_info
+                        unpriced.discard(type_id)
+                        resolved += 1
+                        continue
+                    # We only care if there is a non-zero price. If the price is 0, keep going.
+                    if has_price(pricing_info):
+                        if stage not in LOCAL_STAGES:
+                            # And only cache things which come from an actual provider.
+                            pricing_info['priced_at'] = int(time.time())
+                            to_cache[memcache_type_key(type_id, options=options)] = pricing_info
+                            to_store[type_id] = pricing_info
+                            cache_writes += 1
+                        elif is_stale(pricing_info):
+                            stale.append(type_id)
+                        prices[type_id] = pricing_info
+                        unpriced.discard(type_id)
+                        nmv.pop(type_id, None)
+                        resolved += 1
+                    elif pricing_info['buy']['price'] == 0 and type_id not in nmv:
+                        # If we get a match with no volume, we hold on to it to see if we find one that does.
+                        # If we won't, we'll use this info.
+                        nmv[type_id] = pricing_info
+
+                record_stage_stats(stage, resolved, time.time() - started,
+                                   cache_writes)
+                app.logger.debug("Found %s/%s items using stage: %s",
+                                 resolved, len(modules), stage)
+
+        cache_set_many(to_cache, timeout=app.config['PRICE_CACHE_TIMEOUT'])
+        store_values(to_store, options=options)
+        if providers_complete:
+            # Types only found without volume keep that entry, so it can
+            # still be shown without asking the providers again
+            cache_set_many(
+                dict((negative_type_key(type_id, options=options),
+                      nmv.get(type_id, True))
+                     for type_id in unpriced if type_id not in failed),
+                timeout=app.config['PRICE_NEGATIVE_CACHE_TIMEOUT'])
+    finally:
+        if claim is not None:
+            release_price_fetches(claim[0], options=options)
+
+    if stale:
+        # Serve what we have now, the next request gets fresh prices
+        incr_request_stat('stale_prices_served', len(stale))
+        schedule_price_refresh(stale, options=options)
+
+    pending = claim[1] if claim is not None else []
+    if pending:
+        incr_request_stat('coalesced_prices', len(pending))
+        found = wait_for_price_fetches(pending, options=options)
+        prices.update(found)
+
+        # Anything the other requests didn't come up with is fetched here
+        leftover = [type_id for type_id in pending if type_id not in found]
+        if leftover:
+            prices.update(get_market_prices(
+                leftover,
+                options=dict(options, coalesce=False, prefetched=None)))
 
     # If we don't find a price, but, we got a hit with 0 volume, use that instead since
     # no volume shows differently in the UI from not found at all.
@@ -427,19 +1095,93 @@ def get_market_prices(modules, options=None):
     return prices.items()
 
 
-def create_appraisal(raw_paste, solar_system):
-    if solar_system not in app.config['VALID_SOLAR_SYSTEMS'].keys():
-        abort(400)
+#: Threads that price the markets of multi-market appraisals. They live as
+#: long as the process, so do their price store connections.
+_market_pool = None
+_market_pool_pid = None
+_market_pool_lock = threading.Lock()
+
+
+def get_market_pool():
+    """ Returns the pool of this process, starting it if needed. Pools are
+        never shared with forked processes.
+    """
+    global _market_pool, _market_pool_pid
+    with _market_pool_lock:
+        if _market_pool is None or _market_pool_pid != os.getpid():
+            _market_pool = ThreadPool(len(app.config['VALID_SOLAR_SYSTEMS']))
+            _market_pool_pid = os.getpid()
+        return _market_pool
+
+
+def get_multi_market_prices(modules, markets):
+    """ Prices modules in each of markets. The cached prices of all of the
+        markets are looked up in a single round-trip. The markets are then
+        priced in parallel, so their provider calls overlap. Returns
+        {market: [(typeId, pricing_info), ...]}.
+    """
+    all_options = [{'solarsystem_id': market} for market in markets]
+    keys = []
+    for options in all_options:
+        keys += [memcache_type_key(type_id, options=options)
+                 for type_id in modules]
+        keys.append(warmed_types_key(options=options))
+    values = cache_get_many(keys)
+    for i, options in enumerate(all_options):
+        market_values = values[i * (len(modules) + 1):(i + 1) * (len(modules) + 1)]
+        warmed_types = market_values.pop()
+        options['prefetched'] = (dict(zip(modules, market_values)),
+                                 warmed_types)
+
+    # Price every market with the type database of this request
+    types = get_types()
+
+    def price_market(options):
+        with app.app_context():
+            g.types = types
+            prices = get_market_prices(modules, options=options)
+            return prices, get_request_stats(), g.get('pricing_stages', {})
+
+    results = get_market_pool().map(price_market, all_options)
+
+    # Fold the statistics of the workers into the ones of this request
+    market_prices = {}
+    for market, (prices, stats, stages) in zip(markets, results):
+        market_prices[market] = prices
+        for name, amount in stats.items():
+            incr_request_stat(name, amount)
+        for stage, stage_stats in stages.items():
+            record_stage_stats(stage, stage_stats['resolved'],
+                               stage_stats['seconds'],
+                               stage_stats['cache_writes'])
+    return market_prices
+
+
+def create_appraisal(raw_paste, solar_system, markets=None):
+    """ Parses raw_paste and prices it in solar_system. When markets are
+        given, the paste is also priced in each of them, and the appraisal
+        keeps the prices of every market.
+    """
+    markets = OrderedDict.fromkeys([solar_system] + list(markets or [])).keys()
+    for market in markets:
+        if market not in app.config['VALID_SOLAR_SYSTEMS'].keys():
+            abort(400)
 
     try:
         parse_results = parse(raw_paste)
     except evepaste.Unparsable as ex:
-        if raw_paste:
+        if raw_paste and not isinstance(ex, PasteTooLarge):
             app.logger.warning("User input invalid data: %s", raw_paste)
         return str(ex)
 
     # Populate types with pricing data
-    prices = get_market_prices(list(parse_results['unique_items']), options={'solarsystem_id': solar_system})
+    unique_items = list(parse_results['unique_items'])
+    market_prices = None
+    if len(markets) > 1:
+        market_prices = get_multi_market_prices(unique_items, markets)
+        prices = market_prices[solar_system]
+    else:
+        prices = get_market_prices(unique_items, options={'solarsystem_id': solar_system})
 
     # create a session if we need one
     createsession()
@@ -450,9 +1192,11 @@ def create_appraisal(raw_paste, solar_system):
                            Kind=parse_results['representative_kind'],
                            Prices=prices,
                            Parsed=parse_results['results'],
-                           ParsedVersion=1,
+                           ParsedVersion=PARSED_VERSION,
                            BadLines=parse_results['bad_lines'],
                            Market=solar_system,
+                           MarketPrices=market_prices,
+                           TypesVersion=get_types().version,
                            Public=bool(session['options'].get('share')),
                            UserId=g.user.Id if g.user else None,
                            SessionId=None if g.user else session['epsessionid'])
@@ -462,5 +1206,11 @@ def create_appraisal(raw_paste, solar_system):
     app.logger.debug("New Appraisal [%s]: %s",
                      appraisal.Id,
                      parse_results['representative_kind'])
+    app.logger.debug("Request stats [%s]: %s",
+                     appraisal.Id,
+                     get_request_stats())
+    app.logger.debug("Pricing breakdown [%s]: %s",
+                     appraisal.Id,
+                     format_pricing_breakdown())
 
     return appraisal
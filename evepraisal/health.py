@@ -0,0 +1,60 @@
+""" Health tracking for the remote market data providers.
+
+    Each provider has a circuit breaker. After PROVIDER_FAILURE_THRESHOLD
+    failed calls in a row its circuit opens and the provider is skipped for
+    PROVIDER_COOLDOWN seconds. The state lives in the cache so that every
+    worker sees the same picture.
+"""
+from . import app, cache
+
+
+def _key(provider, name):
+    return "provider:%s:%s" % (provider, name)
+
+
+def is_outage(error):
+    """ Connection failures and server errors count against a provider,
+        client errors (4xx) don't.
+    """
+    return error.status is None or error.status >= 500
+
+
+def is_available(provider):
+    """ Returns False while the provider's circuit is open. """
+    return not cache.get(_key(provider, 'open'))
+
+
+def record_success(provider):
+    cache.delete(_key(provider, 'failures'))
+
+
+def record_failure(provider):
+    failures_key = _key(provider, 'failures')
+    # Workers fail at the same time, count atomically so no failure is lost.
+    # Flask-Cache's own add() doesn't pass on whether the key was added.
+    if cache.cache.add(failures_key, 1,
+                       timeout=app.config['PROVIDER_COOLDOWN']):
+        failures = 1
+    else:
+        # The counter may have just expired or been reset
+        failures = cache.cache.inc(failures_key) or 1
+    if failures >= app.config['PROVIDER_FAILURE_THRESHOLD']:
+        app.logger.warning("Opening circuit for %s after %s failures",
+                           provider, failures)
+        cache.set(_key(provider, 'open'), True,
+                  timeout=app.config['PROVIDER_COOLDOWN'])
+        cache.delete(failures_key)
+
+
+def record_call(provider, attempts, errors):
+    """ Records the outcome of one call to a provider, given how many
+        requests it made and the httpclient.HTTPErrors they raised. The call
+        only counts as a failure when none of its requests got through.
+    """
+    if attempts == 0:
+        return
+    outages = [e for e in errors if is_outage(e)]
+    if outages and len(outages) == attempts:
+        record_failure(provider)
+    else:
+        record_success(provider)
@@ -1,9 +1,11 @@
 import uuid
+from collections import OrderedDict
 from functools import wraps
 
-from flask import g, redirect, url_for, request, flash, session
+from flask import (
+    g, redirect, url_for, request, flash, session, has_app_context)
 
-from . import app
+from . import app, cache
 
 
 def login_required_if_config(func):
@@ -33,6 +35,36 @@ def inject_ad_and_tracking_parameters():
     )
 
 
+def get_requested_markets():
+    """ Returns the extra markets asked for with the 'markets' form field,
+        given either repeatedly or as a comma separated list.
+    """
+    return [market.strip()
+            for value in request.form.getlist('markets')
+            for market in value.split(',') if market.strip()]
+
+
+def iter_lines(raw_paste):
+    """ Yields the lines of raw_paste as evepaste's split_and_strip returns
+        them, stripped and without the empty ones, one at a time instead of
+        splitting the whole paste up front.
+    """
+    start = 0
+    while start <= len(raw_paste):
+        end = raw_paste.find('\n', start)
+        if end == -1:
+            line = raw_paste[start:]
+            start = len(raw_paste) + 1
+        else:
+            line = raw_paste[start:end]
+            start = end + 1
+            if line.endswith('\r'):
+                line = line[:-1]
+        line = line.strip(' ').replace(u"\xa0", u"").replace(u"\xc2", u"")
+        if line:
+            yield line
+
+
 def iter_types(kind, result):
     if kind == 'bill_of_materials':
         for item in result:
@@ -68,6 +100,76 @@ def iter_types(kind, result):
             yield item
 
 
+def incr_request_stat(name, amount=1):
+    """ Adds to a counter that lives for the current request. Does nothing
+        when called outside of an application context.
+    """
+    if not has_app_context():
+        return
+    stats = g.setdefault('request_stats', {})
+    stats[name] = stats.get(name, 0) + amount
+
+
+def get_request_stats():
+    """ Returns the counters collected with incr_request_stat. """
+    if not has_app_context():
+        return {}
+    return g.get('request_stats', {})
+
+
+def incr_shared_stat(name, amount=1):
+    """ Adds to a counter that is kept in the cache, so it is shared by every
+        worker.
+    """
+    key = "stats:%s" % name
+    # Flask-Cache's own add() doesn't pass on whether the key was added
+    if not cache.cache.add(key, amount, timeout=24 * 60 * 60):
+        cache.cache.inc(key, amount)
+
+
+def pop_shared_stats(names):
+    """ Returns the named shared counters and resets them to zero. """
+    keys = ["stats:%s" % name for name in names]
+    values = cache.get_many(*keys)
+    cache.delete_many(*keys)
+    return dict((name, value or 0) for name, value in zip(names, values))
+
+
+def record_stage_stats(stage, resolved, seconds, cache_writes):
+    """ Adds one run of a pricing stage to the pricing breakdown of the
+        current request. Does nothing outside of an application context.
+    """
+    if not has_app_context():
+        return
+    stages = g.setdefault('pricing_stages', OrderedDict())
+    stats = stages.setdefault(stage, {'resolved': 0, 'seconds': 0.0,
+                                      'cache_writes': 0})
+    stats['resolved'] += resolved
+    stats['seconds'] += seconds
+    stats['cache_writes'] += cache_writes
+
+
+def format_pricing_breakdown():
+    """ Returns the pricing breakdown of the current request as one line,
+        for logs and the X-Pricing-Breakdown debug header.
+    """
+    if not has_app_context():
+        return ''
+    return '; '.join(
+        '%s: %d priced in %.3fs, %d cached' % (
+            stage, stats['resolved'], stats['seconds'], stats['cache_writes'])
+        for stage, stats in g.get('pricing_stages', {}).items())
+
+
+@app.after_request
+def add_pricing_breakdown_header(response):
+    if app.debug:
+        breakdown = format_pricing_breakdown()
+        if breakdown:
+            response.headers['X-Pricing-Breakdown'] = breakdown
+    return response
+
+
 def createsession():
     """ this method creates a session if one doesn't exist.
     """
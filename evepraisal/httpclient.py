@@ -0,0 +1,122 @@
+""" A shared HTTP client for the market data providers.
+
+    Connections are pooled and kept alive per host, so consecutive API calls
+    don't pay for a new TCP connection (and TLS handshake) every time. The
+    pool belongs to the process that created it; a forked worker builds its
+    own the first time it makes a request.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+import urllib3
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.packages import six
+
+from . import app
+
+
+class HTTPError(Exception):
+    """ Raised when a provider can't be reached or answers with an error
+        status. status is None when no response was received at all.
+    """
+    def __init__(self, url, status=None, reason=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        super(HTTPError, self).__init__(
+            "%s: %s" % (url, status if status is not None else reason))
+
+
+class Retry(urllib3.Retry):
+    """ Retries a request whose connection broke before an answer came,
+        which is what a pooled keep-alive connection the server closed while
+        idle looks like. A provider that is too slow to answer isn't asked
+        again, hedging covers those.
+    """
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            six.reraise(type(error), error, _stacktrace)
+        return super(Retry, self).increment(
+            method, url, response=response, error=error, _pool=_pool,
+            _stacktrace=_stacktrace)
+
+
+#: One reconnect for a stale pooled connection, and a few redirects. It is
+#: passed with every request too: for redirects to another host PoolManager
+#: otherwise goes by urllib3's defaults.
+RETRIES = Retry(total=4, connect=1, read=1, redirect=3)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """ Returns the connection pool for this process, creating it if needed.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # Sockets inherited from a parent process are never reused. They
+            # are shared with the parent, so talking over them would mix up
+            # responses between the two.
+            _pool = urllib3.PoolManager(
+                maxsize=app.config['HTTP_POOL_SIZE'],
+                block=True,
+                retries=RETRIES,
+                timeout=urllib3.Timeout(
+                    connect=app.config['HTTP_CONNECT_TIMEOUT'],
+                    read=app.config['HTTP_READ_TIMEOUT']),
+                headers={
+                    'User-Agent': app.config['USER_AGENT'],
+                    'Accept-Encoding': 'gzip',
+                })
+            _pool_pid = pid
+    return _pool
+
+
+def fetch(url):
+    """ Performs a GET request and returns the (decompressed) response body.
+    """
+    try:
+        response = get_pool().request('GET', url, retries=RETRIES)
+    except urllib3.exceptions.HTTPError as e:
+        raise HTTPError(url, reason=str(e))
+
+    if response.status >= 400:
+        raise HTTPError(url, status=response.status)
+    return response.data
+
+
+@contextmanager
+def stream(url):
+    """ Performs a GET request and yields the response as a file like object
+        so the body can be consumed while it arrives. The connection goes
+        back to the pool once the body has been read.
+    """
+    try:
+        response = get_pool().request('GET', url, preload_content=False,
+                                      retries=RETRIES)
+    except urllib3.exceptions.HTTPError as e:
+        raise HTTPError(url, reason=str(e))
+
+    completed = False
+    try:
+        if response.status >= 400:
+            raise HTTPError(url, status=response.status)
+        yield response
+        # Drain anything the caller left unread so the connection is clean
+        response.read()
+        completed = True
+    except urllib3.exceptions.HTTPError as e:
+        raise HTTPError(url, reason=str(e))
+    finally:
+        if not completed:
+            response.close()
+        response.release_conn()
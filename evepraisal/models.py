@@ -1,22 +1,80 @@
 import json
+import signal
+from itertools import izip
 
+from flask import g, has_app_context, has_request_context
 from sqlalchemy import types
 from sqlalchemy.exc import OperationalError
 
+import typedb
 from helpers import iter_types
-from . import db
+from typedb import get_repackaged_volume, update_types_repackaged  # NOQA
+from . import app, db
 
 
 class JsonType(types.TypeDecorator):
     impl = types.VARCHAR
 
     def process_bind_param(self, value, engine):
+        if value is None:
+            return None
         return json.dumps(value)
 
     def process_result_value(self, value, engine):
+        if value is None:
+            return None
         return json.loads(value)
 
 
+class AppraisalItem(object):
+    """ An item of an appraisal: what was parsed from the paste, its price
+        and the details of its type. It reads like a dict, with the type's
+        fields showing through, so the type isn't copied into every item.
+    """
+    __slots__ = ('fields', 'details')
+
+    def __init__(self, fields, details=None):
+        self.fields = fields
+        self.details = details
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return self.fields[key]
+        if self.details is not None:
+            return self.details[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.fields[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.fields or (self.details is not None and
+                                      key in self.details)
+
+    def keys(self):
+        keys = list(self.fields)
+        if self.details is not None:
+            keys.extend(key for key in self.details
+                        if key not in self.fields)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def as_dict(self):
+        """ Returns the item as a dict, for serializing. """
+        return dict(self.items())
+
+
 class Appraisals(db.Model):
     __tablename__ = 'Appraisals'
 
@@ -36,16 +94,32 @@ class Appraisals(db.Model):
     #: Bad Lines
     BadLines = db.Column(JsonType())
     Market = db.Column(db.Integer())
+    #: Prices per market, {market: prices}, for appraisals priced in more
+    #: than one market. Prices holds the ones of Market.
+    MarketPrices = db.Column(JsonType(), nullable=True)
+    #: Version of the type database the appraisal was parsed with
+    TypesVersion = db.Column(db.Text(), nullable=True)
     Created = db.Column(db.Integer(), index=True)
     Public = db.Column(db.Boolean(), index=True, default=True)
     UserId = db.Column(db.Integer(), db.ForeignKey('Users.Id'), index=True)
     SessionId = db.Column(db.Text(), nullable=True, index=True)
 
 
-    def totals(self):
+    def markets(self):
+        """ Returns the markets this appraisal was priced in. """
+        if self.MarketPrices:
+            return sorted(self.MarketPrices,
+                          key=lambda m: (m != str(self.Market), m))
+        return [str(self.Market)]
+
+    def market_totals(self):
+        """ Returns [(market, totals), ...] for every priced market. """
+        return [(market, self.totals(market)) for market in self.markets()]
+
+    def totals(self, market=None):
         total_sell = total_buy = total_volume = total_repackaged = 0
 
-        for item in self.iter_types():
+        for item in self.iter_types(market):
             # Don't factor blueprint copies into the total
             if item.get('bpc'):
                 continue
@@ -71,27 +145,54 @@ class Appraisals(db.Model):
             [[kind, result], [kind, result]]
 
         """
+        if self.ParsedVersion == 2:
+            return [[kind, result] for kind, result, _ in self.Parsed]
         if self.ParsedVersion == 1:
             return self.Parsed
 
         return [[self.Kind, self.Parsed]]
 
-    def iter_types(self):
-        price_map = dict(self.Prices)
-        for kind, parsed in self.result_list():
-            for item in iter_types(kind, parsed):
-                details = get_type_by_name(item['name'])
+    def iter_resolved(self):
+        """ Yields (fields, details) for every parsed item, details being
+            the item's type or None. Version 2 results keep the typeID of
+            each item, older ones are looked up by name.
+        """
+        if self.ParsedVersion != 2:
+            for kind, parsed in self.result_list():
+                for fields in iter_types(kind, parsed):
+                    yield fields, get_type_by_name(fields['name'])
+            return
+
+        for kind, parsed, resolved in self.Parsed:
+            for fields, found in izip(iter_types(kind, parsed), resolved):
+                details = get_type_by_id(found[0]) if found else None
+                if found and details is None:
+                    # The type is gone from the type database since, keep
+                    # what was known about it
+                    fields['typeID'], fields['typeName'] = found
+                yield fields, details
+
+    def iter_types(self, market=None):
+        if market is not None and self.MarketPrices:
+            price_map = dict(self.MarketPrices.get(str(market)) or [])
+        else:
+            price_map = dict(self.Prices)
+        for fields, details in self.iter_resolved():
+            item = AppraisalItem(fields, details)
+            item['prices'] = None
+            if details:
+                # The type's details win over parsed fields of the
+                # same name
+                for key in details:
+                    fields.pop(key, None)
+                item['prices'] = price_map.get(details.typeID)
+
+            if 'BLUEPRINT COPY' in item.get('details', ''):
+                item['bpc'] = True
                 item['prices'] = None
-                if details:
-                    item.update(details)
-                    item['prices'] = price_map.get(item['typeID'])
-
-                if 'BLUEPRINT COPY' in item.get('details', ''):
-                    item['bpc'] = True
-                    item['prices'] = None
 
-                item['quantity'] = item.get('quantity', 1)
-                yield item
+            item['quantity'] = item.get('quantity', 1)
+            yield item
 
 
 class Users(db.Model):
@@ -120,59 +221,82 @@ def row_to_dict(row):
                 for col in row.__table__.columns.keys())
 
 
-def update_types_repackaged(types):
-    """Updates a set of items to have a repackaged size where applicable."""
-    for t in types:
-        rpkg_volume = get_repackaged_volume(t['groupID'])
-        if rpkg_volume > -1:
-            t['repackaged_volume'] = rpkg_volume
-
-def get_repackaged_volume(groupId):
-    """ This returns the repackaged size for a particular group."""
-    shiptype = ''
-
-    if groupId in [31]:
-        shiptype = 'shuttle'
-    elif groupId in [25, 237, 324, 830, 831, 834, 893, 1283, 1527]:
-        shiptype = 'frigate'
-    elif groupId in [463, 543]:
-        shiptype = 'mining'
-    elif groupId in [420, 541, 963, 1305, 1534]:
-        shiptype = 'destroyer'
-    elif groupId in [26, 358, 832, 833, 894, 906]:
-        shiptype = 'cruiser'
-    elif groupId in [419, 540, 1201]:
-        shiptype = 'bcruiser'
-    elif groupId in [28, 380, 1202]:
-        shiptype = 'industrial'
-    elif groupId in [27, 898, 900]:
-        shiptype = 'bship'
-
-    return {
-        'shuttle' : 500,
-        'frigate' : 2500,
-        'mining' : 3750,
-        'destroyer' : 5000,
-        'cruiser' : 10000,
-        'bcruiser' : 15000,
-        'industrial' : 20000,
-        'bship' : 50000,
-        '' : -1
-    }[shiptype]
-
-TYPES = json.loads(open('data/types.json').read())
-update_types_repackaged(TYPES)
-TYPES_BY_NAME = dict((t['typeName'].lower(), t) for t in TYPES)
-TYPES_BY_ID = dict((t['typeID'], t) for t in TYPES)
+TYPES = typedb.TypeDBHandle(app.config['TYPE_DB_PATH'],
+                            json_path=app.config['TYPES_JSON_PATH'],
+                            check_interval=app.config['TYPE_DB_CHECK_INTERVAL'])
+
+if app.config['TYPE_DB_RELOAD_SIGNAL']:
+    try:
+        signal.signal(getattr(signal, app.config['TYPE_DB_RELOAD_SIGNAL']),
+                      lambda signum, frame: TYPES.expire())
+    except ValueError:
+        # Not in the main thread
+        app.logger.warning("Could not install the type database reload "
+                           "signal handler")
+
+
+@app.before_request
+def check_types():
+    try:
+        if TYPES.check():
+            app.logger.info("Loaded type database version %s",
+                            TYPES.version)
+    except Exception:
+        app.logger.exception("Could not reload the type database")
+
+
+def get_types():
+    """ Returns the type database to use. A request sticks to the version
+        it started with, even if a new one is swapped in meanwhile.
+    """
+    types = g.get('types') if has_app_context() else None
+    if types is None:
+        types = TYPES.current
+        if has_request_context():
+            g.types = types
+    return types
+
 
 def get_type_by_name(name):
     if not name:
         return
     s = name.lower().strip()
-    return (TYPES_BY_NAME.get(s.rstrip('*')) or TYPES_BY_NAME.get(s))
+    stripped = s.rstrip('*')
+    types = get_types()
+    details = types.get_by_name(stripped)
+    if details is None and stripped != s:
+        details = types.get_by_name(s)
+    return details
 
 
 def get_type_by_id(typeID):
     if not typeID:
         return
-    return TYPES_BY_ID.get(typeID)
+    return get_types().get_by_id(typeID)
+
+
+def starts_type_name(words):
+    """ Returns True if a type name may start with words. """
+    words = words.strip()
+    stripped = words.rstrip('*')
+    types = get_types()
+    return bool(words) and (types.is_name_prefix(stripped) or
+                            (stripped != words and
+                             types.is_name_prefix(words)))
+
+
+def match_type_name(words):
+    """ Returns how many of words, from the first one, make up the longest
+        type name they start with, or 0. Words are added one at a time and
+        the search stops as soon as they can't be the start of a name, so a
+        line is looked at once instead of once per prefix.
+    """
+    longest = 0
+    name = ''
+    for i, word in enumerate(words):
+        name = name + ' ' + word if i else word
+        if not starts_type_name(name):
+            break
+        if get_type_by_name(name):
+            longest = i + 1
+    return longest
@@ -0,0 +1,155 @@
+""" A cache of parse results shared by every worker.
+
+    The same d-scans, killmails and fits get pasted again and again. Parse
+    results are kept in a SQLite database keyed by a hash of the paste, as
+    the parsers see it, and of the version of the type database it was
+    parsed with, so a new type database never serves old results. Once the
+    cached results take more than PARSE_CACHE_MAX_BYTES, the least recently
+    used ones are evicted.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from helpers import iter_lines
+from . import app
+
+_local = threading.local()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parses (
+    key TEXT PRIMARY KEY,
+    used_at INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS parses_used_at ON parses (used_at);
+CREATE TABLE IF NOT EXISTS parses_size (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO parses_size VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS parses_added AFTER INSERT ON parses BEGIN
+    UPDATE parses_size SET bytes = bytes + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS parses_evicted AFTER DELETE ON parses BEGIN
+    UPDATE parses_size SET bytes = bytes - OLD.size;
+END;
+"""
+
+# Eviction makes room down to this share of PARSE_CACHE_MAX_BYTES, so it
+# doesn't run again on the next insert
+EVICT_TO = 0.9
+EVICT_BATCH = 100
+# Hits only move an entry up the LRU order once per this many seconds
+TOUCH_INTERVAL = 60
+
+
+def is_enabled():
+    return bool(app.config['PARSE_CACHE_PATH'])
+
+
+def get_connection():
+    """ Returns the connection for this thread, opening it if needed.
+        Connections are never shared across threads or forked processes.
+    """
+    pid = os.getpid()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == pid:
+        return conn
+
+    conn = sqlite3.connect(app.config['PARSE_CACHE_PATH'], timeout=5)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    _local.conn = conn
+    _local.pid = pid
+    return conn
+
+
+def parse_key(raw_paste, types_version):
+    """ Returns the cache key of a paste parsed with a type database
+        version. Pastes that differ only in whitespace around lines or in
+        blank lines share a key, the parsers see the same lines.
+    """
+    key = hashlib.sha1('%s\0' % types_version)
+    for i, line in enumerate(iter_lines(raw_paste)):
+        if i:
+            key.update('\n')
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        key.update(line)
+    return key.hexdigest()
+
+
+def get_parsed(key):
+    """ Returns the cached parse result for key, or None. """
+    if not is_enabled():
+        return
+    now = int(time.time())
+    conn = get_connection()
+    row = conn.execute('SELECT used_at, data FROM parses WHERE key = ?',
+                       (key,)).fetchone()
+    if row is None:
+        return
+    used_at, data = row
+    if used_at < now - TOUCH_INTERVAL:
+        with conn:
+            conn.execute('UPDATE parses SET used_at = ? WHERE key = ?',
+                         (now, key))
+
+    parsed = json.loads(zlib.decompress(data))
+    parsed['unique_items'] = set(parsed['unique_items'])
+    return parsed
+
+
+def store_parsed(key, parsed):
+    """ Caches a parse result, evicting the least recently used ones if the
+        cache grows over PARSE_CACHE_MAX_BYTES.
+    """
+    if not is_enabled():
+        return
+    data = zlib.compress(json.dumps({
+        'representative_kind': parsed['representative_kind'],
+        'results': parsed['results'],
+        'bad_lines': parsed['bad_lines'],
+        'unique_items': sorted(parsed['unique_items']),
+    }, separators=(',', ':')))
+    max_bytes = app.config['PARSE_CACHE_MAX_BYTES']
+    if len(data) > max_bytes:
+        return
+
+    conn = get_connection()
+    with conn:
+        # Results are addressed by their content, an existing entry for the
+        # key holds the same result
+        conn.execute('INSERT OR IGNORE INTO parses (key, used_at, size, data) '
+                     'VALUES (?, ?, ?, ?)',
+                     (key, int(time.time()), len(data), sqlite3.Binary(data)))
+        evict(conn, max_bytes)
+
+
+def get_size(conn):
+    return conn.execute('SELECT bytes FROM parses_size').fetchone()[0]
+
+
+def evict(conn, max_bytes):
+    """ Deletes the least recently used entries until the cache is back
+        under EVICT_TO of max_bytes. Returns the number of deleted entries.
+    """
+    evicted = 0
+    if get_size(conn) <= max_bytes:
+        return evicted
+    while get_size(conn) > max_bytes * EVICT_TO:
+        deleted = conn.execute(
+            'DELETE FROM parses WHERE key IN '
+            '(SELECT key FROM parses ORDER BY used_at LIMIT ?)',
+            (EVICT_BATCH,)).rowcount
+        if not deleted:
+            break
+        evicted += deleted
+    return evicted
@@ -0,0 +1,72 @@
+""" A pool of processes to parse big pastes on more than one core.
+
+    Each web worker starts its own pool of PARSE_POOL_PROCESSES processes
+    the first time it needs one. They are forked from the web worker, so
+    the type database it has mapped is theirs too, and they open it before
+    taking any work. The pool lives as long as the web worker.
+"""
+import multiprocessing
+import os
+import signal
+import threading
+from collections import deque
+
+from models import TYPES
+from . import app
+
+_lock = threading.Lock()
+_pool = None
+_pid = None
+
+
+def is_enabled():
+    return app.config['PARSE_POOL_PROCESSES'] > 0
+
+
+def init_worker():
+    # Ctrl-C is for the web worker to handle, not its pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Open the type database before the first chunk comes in
+    len(TYPES)
+
+
+def get_pool():
+    """ Returns the pool of this process, starting it if needed. Pools are
+        never shared with forked processes.
+    """
+    global _pool, _pid
+    with _lock:
+        if _pool is None or _pid != os.getpid():
+            _pool = multiprocessing.Pool(app.config['PARSE_POOL_PROCESSES'],
+                                         initializer=init_worker)
+            _pid = os.getpid()
+        return _pool
+
+
+def reset():
+    """ Stops the pool of this process, the next get_pool() starts a new
+        one.
+    """
+    global _pool
+    with _lock:
+        if _pool is not None and _pid == os.getpid():
+            _pool.terminate()
+        _pool = None
+
+
+def imap(func, iterable):
+    """ Like Pool.imap, yields func(item) for every item in order, but
+        without reading more than two items per process ahead of the results
+        consumed so far. Raises multiprocessing.TimeoutError if a result
+        takes more than PARSE_POOL_TIMEOUT seconds.
+    """
+    pool = get_pool()
+    pending = deque()
+    max_pending = 2 * app.config['PARSE_POOL_PROCESSES']
+    timeout = app.config['PARSE_POOL_TIMEOUT']
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get(timeout)
+    while pending:
+        yield pending.popleft().get(timeout)
@@ -1,23 +1,152 @@
-from collections import defaultdict
+import re
+import sqlite3
+from collections import OrderedDict, defaultdict
 from itertools import takewhile
-from re import sub
 
 import evepaste
 from evepaste import parsers
-from models import get_type_by_name
-from helpers import iter_types
+from evepaste.parsers.eft import EFT_BLACKLIST
+from evepaste.parsers.fitting import FITTING_BLACKLIST
+from models import (TYPES, get_type_by_name, get_types, match_type_name,
+                    starts_type_name)
+from helpers import incr_request_stat, iter_lines, iter_types
+from parsecache import get_parsed, parse_key, store_parsed
+import parsepool
+from . import app
+
+# Characters a quantity in a listing starts with
+QUANTITY_CHARS = frozenset("0123456789,'.")
+
+# Format sniffing looks at this many of the first lines, found in at most
+# SNIFF_CHARS characters
+SNIFF_LINES = 10
+SNIFF_CHARS = 4096
+EFT_HEADER_RE = re.compile(r"^\[[^\]]+,[^\]]*\]$")
+DATE_RE = re.compile(r"^\d\d\d\d.\d\d.\d\d \d\d:\d\d")
+CHAT_TIME_RE = re.compile(r"^\[\d\d:\d\d:\d\d\] ")
+DISTANCE_RE = re.compile(r"^([\d,'\.]* (m|km|AU)|-)$")
+NUMBER_RE = re.compile(r"^[\d,'\.]+$")
+INDUSTRY_RE = re.compile(r"\(\d+ Units?\)$")
+KILLMAIL_MARKERS = ('Victim:', 'Involved parties:', 'Destroyed items:',
+                    'Dropped items:')
+VIEW_CONTENTS_LOCATIONS = frozenset([
+    'Cargo Hold', 'Drone Bay', 'Fuel Bay', 'Low Slot', 'Medium Slot',
+    'High Slot', 'Rig Slot', 'Subsystem', ''])
+# Version of the results parse returns, saved as Appraisals.ParsedVersion.
+# Version 2 results are [kind, result, types], types being [typeID,
+# typeName] of the type of each item iter_types yields for result, or None.
+PARSED_VERSION = 2
+
+# Formats whose lines are parsed independently of each other, big pastes in
+# these can be parsed a chunk of lines at a time
+STREAM_KINDS = frozenset(['cargo_scan', 'assets', 'view_contents',
+                          'contract', 'wallet', 'listing', 'heuristic'])
+
+
+class PasteTooLarge(evepaste.Unparsable):
+    """ Raised for pastes over PASTE_MAX_BYTES bytes or PASTE_MAX_LINES
+        lines.
+    """
 
 
 def parse(raw_paste):
+    """ Parses raw_paste, or returns the cached result of parsing the same
+        paste with the same type database. Results are in the PARSED_VERSION
+        format.
+    """
+    line_count = check_paste_size(raw_paste)
+    version = get_types().version
+    key = (parse_key(raw_paste, '%s:%d' % (version, PARSED_VERSION))
+           if version else None)
+    if key:
+        try:
+            parsed = get_parsed(key)
+        except sqlite3.Error:
+            app.logger.exception("Could not read the parse cache")
+            parsed = None
+        if parsed is not None:
+            incr_request_stat('parse_cache_hits')
+            return parsed
+
+    if is_streamable(raw_paste, line_count):
+        parsed = None
+        if uses_pool(line_count):
+            try:
+                parsed = parse_chunked(iter_lines(raw_paste), parallel=True)
+            except evepaste.Unparsable:
+                raise
+            except Exception:
+                app.logger.exception("Could not parse in the parse pool")
+                parsepool.reset()
+        if parsed is None:
+            parsed = parse_chunked(iter_lines(raw_paste))
+    else:
+        parsed = parse_paste(raw_paste)
+
+    lookup = make_lookup()
+    parsed['results'] = [[kind, result, resolve_types(kind, result, lookup)]
+                         for kind, result in parsed['results']]
+    if key:
+        try:
+            store_parsed(key, parsed)
+        except sqlite3.Error:
+            app.logger.exception("Could not write to the parse cache")
+    return parsed
+
+
+def resolve_types(kind, result, lookup=get_type_by_name):
+    """ Returns [typeID, typeName] of the type of each item iter_types
+        yields for result, or None for the items of unknown types.
+    """
+    resolved = []
+    for item in iter_types(kind, result):
+        details = lookup(item['name'])
+        if details:
+            resolved.append([details['typeID'], details['typeName']])
+        else:
+            resolved.append(None)
+    return resolved
+
+
+def check_paste_size(raw_paste):
+    """ Raises PasteTooLarge if raw_paste is over the configured limits.
+        Returns its number of lines, not counting the empty ones, as they
+        are for the parsers and the parse cache.
+    """
+    max_bytes = app.config['PASTE_MAX_BYTES']
+    size = len(raw_paste)
+    # Characters take up to 4 bytes in UTF-8, only count them when it matters
+    if isinstance(raw_paste, unicode) and size * 4 > max_bytes:
+        size = len(raw_paste.encode('utf-8'))
+    if size > max_bytes:
+        raise PasteTooLarge(
+            "The paste is too large, it can be at most %d KB" %
+            (max_bytes // 1024))
+
+    max_lines = app.config['PASTE_MAX_LINES']
+    line_count = sum(1 for _ in iter_lines(raw_paste))
+    if line_count > max_lines:
+        raise PasteTooLarge(
+            "The paste has too many lines, it can have at most %d" %
+            max_lines)
+    return line_count
+
+
+def get_parser_list():
+    return list(evepaste.PARSER_TABLE) + [
+        ('listing', listing_parser),
+        ('heuristic', tryhard_parser),
+    ]
+
+
+def parse_paste(raw_paste, parser_list=None, lookup=get_type_by_name):
     unique_items = set()
     results = []
     representative_kind = 'unknown'
     largest_kind_num = 0
 
-    parser_list = list(evepaste.PARSER_TABLE) + [
-        ('listing', listing_parser),
-        ('heuristic', tryhard_parser),
-    ]
+    if parser_list is None:
+        parser_list = get_parser_list()
 
     iterations = 0
     while iterations < 10:
@@ -26,15 +155,19 @@ def parse(raw_paste):
             if not parser_list:
                 break
 
-            kind, result, bad_lines = evepaste.parse(raw_paste,
-                                                     parsers=parser_list)
+            if app.config['PARSE_SNIFF']:
+                ordered_parser_list = sniff_parsers(parser_list, raw_paste)
+            else:
+                ordered_parser_list = parser_list
+            kind, result, bad_lines = evepaste.parse(
+                raw_paste, parsers=ordered_parser_list)
 
             if result:
                 # Verify the results has some valid items and gather unique
                 # items
                 item_count = 0
                 for item in iter_types(kind, result):
-                    details = get_type_by_name(item['name'])
+                    details = lookup(item['name'])
                     if details:
                         unique_items.add(details['typeID'])
                         item_count += 1
@@ -43,8 +176,11 @@ def parse(raw_paste):
                     # Narrow down the parser_list to those that didn't get a
                     # chance last time
                     used_parser_list = list(takewhile(lambda p: kind != p[0],
-                                                      parser_list))
-                    parser_list = parser_list[len(used_parser_list)+1:]
+                                                      ordered_parser_list))
+                    remaining = set(p[0] for p in ordered_parser_list[
+                        len(used_parser_list)+1:])
+                    parser_list = [p for p in parser_list
+                                   if p[0] in remaining]
                     continue
 
                 results.append([kind, result])
@@ -75,11 +211,229 @@ def parse(raw_paste):
             'unique_items': unique_items}
 
 
+def sample_lines(raw_paste):
+    """ Returns the first non-empty lines of raw_paste, stripped the way
+        evepaste strips them.
+    """
+    lines = raw_paste[:SNIFF_CHARS].replace('\r\n', '\n').split('\n')
+    if len(raw_paste) > SNIFF_CHARS:
+        # The last line may be cut short
+        lines.pop()
+    lines = [line.strip(' ') for line in lines]
+    return [line for line in lines if line][:SNIFF_LINES]
+
+
+def sniff_line(line):
+    """ Returns the kinds of the parsers a line looks like it was meant for.
+    """
+    if '\t' in line:
+        columns = line.split('\t')
+        if DATE_RE.match(line):
+            return ('wallet',)
+        if line.startswith('\t') or columns[-1] in ('Routed', 'Not routed'):
+            return ('pi',)
+        if len(columns) == 3 and DISTANCE_RE.match(columns[2]):
+            if NUMBER_RE.match(columns[1]):
+                return ('survey_scanner', 'dscan')
+            return ('dscan',)
+        if len(columns) == 4 and columns[2] in VIEW_CONTENTS_LOCATIONS:
+            return ('view_contents',)
+        return ('contract', 'assets', 'view_contents')
+
+    if EFT_HEADER_RE.match(line) or line.lower() in EFT_BLACKLIST:
+        return ('eft',)
+    if DATE_RE.match(line) or line.startswith(KILLMAIL_MARKERS):
+        return ('killmail',)
+    if ' has looted ' in line:
+        return ('loot_history',)
+    if (CHAT_TIME_RE.match(line) or ' > ' in line or
+            '<url=showinfo:' in line):
+        return ('chat',)
+    if line in FITTING_BLACKLIST:
+        return ('fitting',)
+    if INDUSTRY_RE.search(line):
+        return ('industry',)
+    if ', ' in line:
+        # EFT modules with ammo, killmail items with a quantity
+        return ()
+    if line[0] in QUANTITY_CHARS:
+        return ('cargo_scan', 'listing')
+    return ('listing',)
+
+
+def sniff_kinds(raw_paste):
+    """ Returns the kinds of the parsers the first lines of raw_paste look
+        like they were meant for.
+    """
+    kinds = set()
+    for line in sample_lines(raw_paste):
+        kinds.update(sniff_line(line))
+    return kinds
+
+
+def sniff_parsers(parser_list, raw_paste):
+    """ Moves the parsers that the lines of raw_paste look like they were
+        meant for to the front of parser_list, when every line looks like
+        the same format. Their order, and the order of the others, which
+        remain as a fallback, doesn't change. In a paste that mixes formats
+        which parser claims which lines depends on the order of the whole
+        list, so it is left as it is.
+    """
+    kinds = None
+    for line in iter_lines(raw_paste):
+        line_kinds = sniff_line(line)
+        if kinds is None:
+            kinds = line_kinds
+        elif line_kinds != kinds:
+            return parser_list
+    if not kinds:
+        return parser_list
+    return ([p for p in parser_list if p[0] in kinds] +
+            [p for p in parser_list if p[0] not in kinds])
+
+
+def is_streamable(raw_paste, line_count):
+    """ Returns whether raw_paste, of line_count lines, is big enough to be
+        parsed a chunk at a time and in a format that can be.
+    """
+    min_lines = app.config['STREAM_PARSE_MIN_LINES']
+    if not min_lines or line_count < min_lines:
+        return False
+    kinds = sniff_kinds(raw_paste)
+    return bool(kinds) and kinds <= STREAM_KINDS
+
+
+def uses_pool(line_count):
+    """ Returns whether a paste of line_count lines is big enough to be
+        parsed in the parse pool, if there is one.
+    """
+    return (parsepool.is_enabled() and
+            line_count >= app.config['PARSE_POOL_MIN_LINES'])
+
+
+def parse_chunked(lines, parallel=False):
+    """ Parses the lines of a paste in one of the STREAM_KINDS formats
+        STREAM_PARSE_CHUNK_LINES at a time. Items that only differ in their
+        quantity are merged as they come, so memory use follows the number
+        of different items rather than the length of the paste, and no more
+        than STREAM_PARSE_MAX_BAD_LINES bad lines are kept. Only the parsers
+        of STREAM_KINDS formats are tried. Returns what parse_paste returns.
+
+        When parallel, chunks of PARSE_POOL_CHUNK_LINES are parsed in the
+        parse pool and merged in order as they come back.
+    """
+    max_bad_lines = app.config['STREAM_PARSE_MAX_BAD_LINES']
+    if parallel:
+        version = get_types().version
+        chunks = iter_chunks(lines, app.config['PARSE_POOL_CHUNK_LINES'])
+        parsed_chunks = parsepool.imap(parse_pool_chunk,
+                                       ((chunk, version) for chunk in chunks))
+    else:
+        # Chunks mostly have the same types in them, don't look them up
+        # again
+        lookup = make_lookup()
+        chunks = iter_chunks(lines, app.config['STREAM_PARSE_CHUNK_LINES'])
+        parsed_chunks = (parse_chunk(chunk, lookup) for chunk in chunks)
+
+    merged = OrderedDict()
+    kind_counts = defaultdict(int)
+    unique_items = set()
+    bad_lines = []
+    for parsed in parsed_chunks:
+        for kind, result in parsed['results']:
+            kind_counts[kind] += len(result)
+            merge_items(merged.setdefault(kind, OrderedDict()), result)
+        unique_items.update(parsed['unique_items'])
+        bad_lines.extend(parsed['bad_lines'][:max_bad_lines - len(bad_lines)])
+
+    if not merged:
+        raise evepaste.Unparsable('No valid parser found for the given text.')
+
+    representative_kind = max(merged, key=lambda kind: kind_counts[kind])
+    return {'representative_kind': representative_kind,
+            'results': [[kind, items.values()]
+                        for kind, items in merged.items()],
+            'bad_lines': bad_lines,
+            'unique_items': unique_items}
+
+
+def make_lookup():
+    """ Returns a get_type_by_name that remembers the types it found. """
+    found = {}
+
+    def lookup(name):
+        details = found.get(name)
+        if details is None:
+            details = get_type_by_name(name)
+            if details:
+                found[name] = details
+        return details
+    return lookup
+
+
+def iter_chunks(lines, chunk_size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_chunk(chunk, lookup=get_type_by_name):
+    """ Parses one chunk of parse_chunked with the parsers of STREAM_KINDS
+        formats. A chunk none of them can parse is all bad lines.
+    """
+    parser_list = [p for p in get_parser_list() if p[0] in STREAM_KINDS]
+    try:
+        parsed = parse_paste('\n'.join(chunk), parser_list=parser_list,
+                             lookup=lookup)
+    except evepaste.Unparsable:
+        parsed = {'results': [], 'bad_lines': chunk, 'unique_items': set()}
+    # No more are kept anyway
+    del parsed['bad_lines'][app.config['STREAM_PARSE_MAX_BAD_LINES']:]
+    return parsed
+
+
+def parse_pool_chunk(args):
+    """ Runs parse_chunk in a parse pool process, with the same version of
+        the type database as the request the chunk comes from.
+    """
+    chunk, version = args
+    if TYPES.version != version:
+        TYPES.reload()
+    return parse_chunk(chunk, make_lookup())
+
+
+def merge_items(merged, items):
+    """ Adds items to merged, summing the quantities of items that are
+        otherwise the same. Items without a quantity are kept as they are.
+    """
+    for item in items:
+        if 'quantity' not in item:
+            merged[len(merged)] = item
+            continue
+        key = tuple(sorted((k, v) for k, v in item.items()
+                           if k != 'quantity'))
+        if key in merged:
+            merged[key]['quantity'] += item['quantity']
+        else:
+            merged[key] = item
+
+
 def listing_parser(lines):
     results = defaultdict(int)
     bad_lines = []
     lines = [line.strip() for line in lines]
     for line in lines:
+        # Lines that can't start with a type name aren't worth parsing
+        if not any(starts_type_name(word)
+                   for word in listing_name_starts(line)):
+            bad_lines.append(line)
+            continue
+
         if get_type_by_name(line):
             results[line] += 1
         else:
@@ -96,6 +450,16 @@ def listing_parser(lines):
             for name, quantity in results.items()], bad_lines
 
 
+def listing_name_starts(line):
+    """ Returns the words a type name in a listing line can start with:
+        "Name x 10", "10x Name" or "10 x Name".
+    """
+    words = line.split(None, 3)[:3]
+    if words and words[0][0] in QUANTITY_CHARS:
+        return words
+    return words[:1]
+
+
 def dscan_parser(lines):
     results, bad_lines = parsers.parse_dscan(lines)
     items = defaultdict(int)
@@ -153,13 +517,12 @@ def tryhard_parser(lines):
                 break
         else:
             # The above method failed. Now let's try splitting on spaces and
-            # build each part until we find a valid type
+            # look for the longest type name the line starts with, short of
+            # the whole line
             parts = [part.strip(',\t ') for part in line.split(' ')]
-            for i in range(len(parts)):
-                name = ' '.join(parts[:-i])
-                if name and get_type_by_name(name):
-                    results[name] += 1
-                    break
+            length = match_type_name(parts[:-1])
+            if length:
+                results[' '.join(parts[:length])] += 1
             else:
                 bad_lines.append(line)
 
@@ -172,6 +535,6 @@ def tryhard_parser(lines):
 
 def int_convert(s):
     try:
-        return int(sub(r"[,'\. 'x]", '', s))
+        return int(re.sub(r"[,'\. 'x]", '', s))
     except ValueError:
         return
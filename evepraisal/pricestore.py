@@ -0,0 +1,142 @@
+""" A durable, local store of price snapshots.
+
+    It sits between the cache and the remote providers in the pricing chain
+    so that a restarted or flushed memcached doesn't send every type back to
+    the providers. Prices are kept in a SQLite database keyed by market and
+    typeID, and every row remembers when it was priced. Rows older than
+    PRICE_STORE_MAX_AGE are never served.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import app
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+# The process that made sure the database has its schema
+_schema_pid = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prices (
+    market TEXT NOT NULL,
+    type_id INTEGER NOT NULL,
+    priced_at INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (market, type_id)
+);
+CREATE INDEX IF NOT EXISTS prices_priced_at ON prices (priced_at);
+"""
+
+# SQLite refuses statements with more than 999 parameters
+SELECT_CHUNK = 500
+
+
+def is_enabled():
+    return bool(app.config['PRICE_STORE_PATH'])
+
+
+def get_connection():
+    """ Returns the connection for this thread, opening it if needed.
+        Connections are never shared across threads or forked processes.
+    """
+    pid = os.getpid()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == pid:
+        return conn
+
+    create_schema()
+    conn = sqlite3.connect(app.config['PRICE_STORE_PATH'], timeout=5)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    _local.conn = conn
+    _local.pid = pid
+    return conn
+
+
+def create_schema():
+    """ Sets the database up, once per process. Running the schema while
+        other threads have statements prepared makes those fail with
+        "database schema has changed".
+    """
+    global _schema_pid
+    with _schema_lock:
+        if _schema_pid == os.getpid():
+            return
+        conn = sqlite3.connect(app.config['PRICE_STORE_PATH'], timeout=5)
+        try:
+            # WAL lets the web workers read while another process writes.
+            # It is kept in the database file, for every connection.
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+        _schema_pid = os.getpid()
+
+
+def get_stored_values(eve_types, options=None):
+    """ Pricing method: returns the fresh snapshots held for eve_types. A
+        store that can't be read is a miss.
+    """
+    if not eve_types or not is_enabled():
+        return {}
+    if options is None:
+        options = {}
+    if options.get('refresh'):
+        return {}
+
+    market = str(options.get('solarsystem_id', '-1'))
+    oldest = int(time.time()) - app.config['PRICE_STORE_MAX_AGE']
+    found = {}
+    try:
+        conn = get_connection()
+        for i in range(0, len(eve_types), SELECT_CHUNK):
+            chunk = eve_types[i:i + SELECT_CHUNK]
+            rows = conn.execute(
+                'SELECT type_id, priced_at, data FROM prices '
+                'WHERE market = ? AND priced_at >= ? AND type_id IN (%s)' %
+                ','.join('?' * len(chunk)),
+                [market, oldest] + list(chunk))
+            for type_id, priced_at, data in rows:
+                found[type_id] = json.loads(data)
+                found[type_id].setdefault('priced_at', priced_at)
+    except sqlite3.Error:
+        app.logger.exception("Could not read the price store")
+        return {}
+    return found
+
+
+def store_values(prices, options=None):
+    """ Saves {typeId: pricing_info} for a market in a single transaction.
+        Prices that can't be saved are only logged, the cache still has
+        them.
+    """
+    if not prices or not is_enabled():
+        return
+    if options is None:
+        options = {}
+
+    market = str(options.get('solarsystem_id', '-1'))
+    now = int(time.time())
+    try:
+        conn = get_connection()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO prices '
+                '(market, type_id, priced_at, data) VALUES (?, ?, ?, ?)',
+                [(market, type_id, now, json.dumps(pricing_info))
+                 for type_id, pricing_info in prices.items()])
+    except sqlite3.Error:
+        app.logger.exception("Could not write to the price store")
+
+
+def prune():
+    """ Deletes snapshots too old to ever be served again. """
+    if not is_enabled():
+        return 0
+    oldest = int(time.time()) - app.config['PRICE_STORE_MAX_AGE']
+    conn = get_connection()
+    with conn:
+        return conn.execute('DELETE FROM prices WHERE priced_at < ?',
+                            (oldest,)).rowcount
@@ -18,6 +18,8 @@ app.route('/latest')(views.latest)
 app.route('/legal')(views.legal)
 # app.route('/freighter')(views.display_buyback_form())
 
+app.errorhandler(413)(views.request_too_large)
+
 # Static Stuff (should really be served from a legit file server)
 app.route('/robots.txt')(views.static_from_root)
 app.route('/favicon.ico')(views.static_from_root)
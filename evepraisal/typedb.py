@@ -0,0 +1,561 @@
+""" A compact, read-only database of EVE types.
+
+    data/types.json is compiled into a binary file (see tools/build_typedb.py)
+    made of sorted arrays and string tables. The file is mapped into memory,
+    so opening it doesn't parse anything, every worker shares the same pages
+    through the page cache and a lookup only touches the few pages it needs.
+    A set of the leading words of every name lets parsers find the longest
+    type name at the start of a line one word at a time.
+    Lookups hand out small TypeRecord objects that live as long as the
+    request using them. A TypeDBHandle swaps in a new version of the file
+    while the process keeps running.
+
+    Layout, little endian: a header, a table with the (offset, length) of
+    every section in SECTIONS, then the sections themselves. Records are
+    fixed size and ordered by typeID. Lowercased names are kept sorted.
+    Open addressing hash tables over typeIDs and names serve exact lookups.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+MAGIC = 'EPTYPEDB'
+FORMAT_VERSION = 2
+#: magic, format version, number of records, number of name keys, digest
+#: of the source types.json
+HEADER = struct.Struct('<8sIII40s')
+SECTION = struct.Struct('<II')
+#: typeID, groupID, volume, repackaged volume (-1 for none), market, and the
+#: start and end of the name and of the extra fields in their string tables
+RECORD = struct.Struct('<IIddBIIII')
+U32 = struct.Struct('<I')
+U32_PAIR = struct.Struct('<II')
+SECTIONS = [
+    # The typeID of every record
+    'type_ids',
+    # RECORD rows
+    'records',
+    # Hash table of record number + 1 by typeID, 0 for empty slots
+    'id_slots',
+    # Per distinct lowercased name in sorted order: the record it belongs
+    # to, and its start in keys (plus one final end offset)
+    'key_records',
+    'key_offsets',
+    # Hash table of key number + 1 by crc32 of the key, 0 for empty slots
+    'key_slots',
+    # Hash set of the crc32 of the leading words of every key, see
+    # prefix_hash
+    'prefix_slots',
+    # String tables
+    'names',
+    'keys',
+    'extras',
+]
+#: Fields stored in the records, everything else goes to extras as JSON
+RECORD_FIELDS = ['typeID', 'typeName', 'groupID', 'volume', 'market',
+                 'repackaged_volume']
+FIXED_FIELDS = frozenset(RECORD_FIELDS)
+
+
+def get_repackaged_volume(groupId):
+    """ This returns the repackaged size for a particular group."""
+    shiptype = ''
+
+    if groupId in [31]:
+        shiptype = 'shuttle'
+    elif groupId in [25, 237, 324, 830, 831, 834, 893, 1283, 1527]:
+        shiptype = 'frigate'
+    elif groupId in [463, 543]:
+        shiptype = 'mining'
+    elif groupId in [420, 541, 963, 1305, 1534]:
+        shiptype = 'destroyer'
+    elif groupId in [26, 358, 832, 833, 894, 906]:
+        shiptype = 'cruiser'
+    elif groupId in [419, 540, 1201]:
+        shiptype = 'bcruiser'
+    elif groupId in [28, 380, 1202]:
+        shiptype = 'industrial'
+    elif groupId in [27, 898, 900]:
+        shiptype = 'bship'
+
+    return {
+        'shuttle' : 500,
+        'frigate' : 2500,
+        'mining' : 3750,
+        'destroyer' : 5000,
+        'cruiser' : 10000,
+        'bcruiser' : 15000,
+        'industrial' : 20000,
+        'bship' : 50000,
+        '' : -1
+    }[shiptype]
+
+
+def update_types_repackaged(types):
+    """Updates a set of items to have a repackaged size where applicable."""
+    for t in types:
+        rpkg_volume = get_repackaged_volume(t['groupID'])
+        if rpkg_volume > -1:
+            t['repackaged_volume'] = rpkg_volume
+
+
+def name_key(name):
+    """ Returns the key a type name is indexed under. """
+    if isinstance(name, str):
+        try:
+            name.decode('ascii')
+        except UnicodeDecodeError:
+            name = name.decode('utf-8', 'replace')
+        else:
+            return name.lower()
+    return name.lower().encode('utf-8')
+
+
+def id_hash(typeID):
+    """ Spreads typeIDs, which come in dense runs, over the hash table. """
+    h = (typeID * 2654435761) & 0xFFFFFFFF
+    return h ^ (h >> 16)
+
+
+def prefix_hash(key):
+    """ Hashes a name prefix for the prefix set. 0 marks empty slots, so it
+        is folded into 1.
+    """
+    return zlib.crc32(key) & 0xFFFFFFFF or 1
+
+
+def name_prefixes(key):
+    """ Yields the leading words of a key: 'a', 'a b', 'a b c' for 'a b c'.
+    """
+    end = key.find(' ')
+    while end != -1:
+        yield key[:end]
+        end = key.find(' ', end + 1)
+    yield key
+
+
+def _u32_array(values):
+    return struct.pack('<%dI' % len(values), *values)
+
+
+def _string_table(strings):
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+    return offsets, ''.join(strings)
+
+
+def _hash_table(hashes):
+    """ Lays out an open addressing table with linear probing. Slots hold
+        the position of the hashed item plus one.
+    """
+    size = 1
+    while size < len(hashes) * 2:
+        size *= 2
+    slots = [0] * size
+    for i, h in enumerate(hashes):
+        slot = h & (size - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (size - 1)
+        slots[slot] = i + 1
+    return slots
+
+
+def _hash_set(values):
+    """ Lays out an open addressing set of non zero values with linear
+        probing.
+    """
+    size = 1
+    while size < len(values) * 2:
+        size *= 2
+    slots = [0] * size
+    for value in values:
+        slot = value & (size - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (size - 1)
+        slots[slot] = value
+    return slots
+
+
+def compile_types(types, path, digest=''):
+    """ Writes types, a list of type dicts as found in types.json, to a type
+        database at path. The file is replaced atomically, so readers never
+        see it half written.
+    """
+    update_types_repackaged(types)
+    by_id = dict((t['typeID'], t) for t in types)
+    records = [by_id[type_id] for type_id in sorted(by_id)]
+    index = dict((t['typeID'], i) for i, t in enumerate(records))
+
+    # Later types win over earlier ones with the same name, like they did
+    # when types were kept in a dict by name
+    key_to_record = {}
+    for t in types:
+        key_to_record[name_key(t['typeName'])] = index[t['typeID']]
+    keys = sorted(key_to_record)
+    prefixes = set(prefix_hash(prefix) for key in keys
+                   for prefix in name_prefixes(key))
+
+    name_offsets, names = _string_table(
+        [t['typeName'].encode('utf-8') for t in records])
+    key_offsets, key_table = _string_table(keys)
+    extra_offsets, extras = _string_table([
+        json.dumps(dict((k, v) for k, v in t.items()
+                        if k not in FIXED_FIELDS), separators=(',', ':'))
+        if set(t) - FIXED_FIELDS else ''
+        for t in records])
+
+    sections = {
+        'type_ids': _u32_array([t['typeID'] for t in records]),
+        'records': ''.join(
+            RECORD.pack(t['typeID'], t['groupID'], t['volume'],
+                        t.get('repackaged_volume', -1), bool(t['market']),
+                        name_offsets[i], name_offsets[i + 1],
+                        extra_offsets[i], extra_offsets[i + 1])
+            for i, t in enumerate(records)),
+        'key_records': _u32_array([key_to_record[key] for key in keys]),
+        'key_offsets': _u32_array(key_offsets),
+        'id_slots': _u32_array(_hash_table([id_hash(t['typeID'])
+                                            for t in records])),
+        'key_slots': _u32_array(_hash_table([zlib.crc32(key)
+                                             for key in keys])),
+        'prefix_slots': _u32_array(_hash_set(sorted(prefixes))),
+        'names': names,
+        'keys': key_table,
+        'extras': extras,
+    }
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(records),
+                                len(keys), digest))
+            offset = HEADER.size + SECTION.size * len(SECTIONS)
+            for name in SECTIONS:
+                # Keep every section 8 byte aligned
+                offset += -offset % 8
+                f.write(SECTION.pack(offset, len(sections[name])))
+                offset += len(sections[name])
+            for name in SECTIONS:
+                f.write('\0' * (-f.tell() % 8))
+                f.write(sections[name])
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compile_file(json_path, path):
+    """ Compiles the types.json file at json_path to a type database. """
+    with open(json_path) as f:
+        types = json.load(f)
+    compile_types(types, path, digest=file_digest(json_path))
+
+
+class TypeRecord(object):
+    """ A type, read only. It reads like the dicts found in types.json ([],
+        get, in, keys, items) without the weight of a dict per type.
+    """
+    __slots__ = ('typeID', 'typeName', 'groupID', 'volume', 'market',
+                 'repackaged_volume', 'extras')
+
+    def __init__(self, typeID, typeName, groupID, volume, market,
+                 repackaged_volume=None, extras=None):
+        self.typeID = typeID
+        self.typeName = typeName
+        self.groupID = groupID
+        self.volume = volume
+        self.market = market
+        self.repackaged_volume = repackaged_volume
+        self.extras = extras
+
+    def __getitem__(self, key):
+        if key in FIXED_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        elif self.extras and key in self.extras:
+            return self.extras[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        keys = [key for key in RECORD_FIELDS if getattr(self, key) is not None]
+        if self.extras:
+            keys.extend(self.extras)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __nonzero__(self):
+        # A record always has its fields, there's no need to count them
+        return True
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def as_dict(self):
+        """ Returns the type as a dict, for serializing. """
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, TypeRecord):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<TypeRecord %s %r>' % (self.typeID, self.typeName)
+
+
+class TypeDB(object):
+    """ A type database file mapped into memory. Lookups return a new
+        TypeRecord per call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.identity = file_identity(os.fstat(f.fileno()))
+
+        (magic, format_version, self._count, self._key_count,
+         digest) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError("%s is not a type database this version can "
+                             "read" % path)
+        self.digest = digest.rstrip('\0')
+        #: Identifies the types in the database: the digest of the types.json
+        #: it was compiled from
+        self.version = self.digest or None
+
+        self._sections = {}
+        lengths = {}
+        for i, name in enumerate(SECTIONS):
+            self._sections[name], lengths[name] = SECTION.unpack_from(
+                self._map, HEADER.size + SECTION.size * i)
+        self._id_mask = lengths['id_slots'] // U32.size - 1
+        self._key_mask = lengths['key_slots'] // U32.size - 1
+        self._prefix_mask = lengths['prefix_slots'] // U32.size - 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield self.record(i)
+
+    def record(self, i):
+        """ Returns record number i. """
+        (type_id, group_id, volume, repackaged_volume, market, name_start,
+         name_end, extra_start, extra_end) = RECORD.unpack_from(
+             self._map, self._sections['records'] + RECORD.size * i)
+        names = self._sections['names']
+        extras = None
+        if extra_end > extra_start:
+            offset = self._sections['extras']
+            extras = json.loads(
+                self._map[offset + extra_start:offset + extra_end])
+        return TypeRecord(
+            type_id,
+            self._map[names + name_start:names + name_end].decode('utf-8'),
+            group_id, volume, bool(market),
+            int(repackaged_volume) if repackaged_volume >= 0 else None,
+            extras)
+
+    def find_id(self, typeID):
+        """ Returns the record number of a typeID, or None. """
+        try:
+            typeID = int(typeID)
+        except (TypeError, ValueError):
+            return
+        sections = self._sections
+        slot = id_hash(typeID) & self._id_mask
+        while True:
+            record_number = U32.unpack_from(
+                self._map, sections['id_slots'] + U32.size * slot)[0]
+            if not record_number:
+                return
+            if U32.unpack_from(
+                    self._map, sections['type_ids'] +
+                    U32.size * (record_number - 1))[0] == typeID:
+                return record_number - 1
+            slot = (slot + 1) & self._id_mask
+
+    def find_name(self, name):
+        """ Returns the record number of a type name, ignoring case, or
+            None.
+        """
+        key = name_key(name)
+        sections = self._sections
+        slot = zlib.crc32(key) & self._key_mask
+        while True:
+            key_number = U32.unpack_from(
+                self._map, sections['key_slots'] + U32.size * slot)[0]
+            if not key_number:
+                return
+            start, end = U32_PAIR.unpack_from(
+                self._map, sections['key_offsets'] + U32.size * (key_number - 1))
+            if self._map[sections['keys'] + start:
+                         sections['keys'] + end] == key:
+                return U32.unpack_from(
+                    self._map,
+                    sections['key_records'] + U32.size * (key_number - 1))[0]
+            slot = (slot + 1) & self._key_mask
+
+    def is_name_prefix(self, words):
+        """ Returns True if words, ignoring case, are the leading words of a
+            type name, or a whole name. Only hashes are kept, so a rare
+            false positive is possible but never a false negative.
+        """
+        value = prefix_hash(name_key(words))
+        slot = value & self._prefix_mask
+        while True:
+            found = U32.unpack_from(
+                self._map, self._sections['prefix_slots'] + U32.size * slot)[0]
+            if not found:
+                return False
+            if found == value:
+                return True
+            slot = (slot + 1) & self._prefix_mask
+
+    def get_by_id(self, typeID):
+        i = self.find_id(typeID)
+        if i is not None:
+            return self.record(i)
+
+    def get_by_name(self, name):
+        i = self.find_name(name)
+        if i is not None:
+            return self.record(i)
+
+
+def file_identity(stat):
+    """ Returns what tells a file apart from the one it replaced. """
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def is_outdated(path, json_path):
+    """ Returns True if the database at path is missing, older than
+        json_path or written in another format version.
+    """
+    if (not os.path.exists(path) or
+            os.path.getmtime(path) < os.path.getmtime(json_path)):
+        return True
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return True
+    magic, format_version = HEADER.unpack(header)[:2]
+    return magic != MAGIC or format_version != FORMAT_VERSION
+
+
+def load(path, json_path=None):
+    """ Opens the type database at path. When json_path is given, the
+        database is (re)compiled from it first if it is missing or older.
+    """
+    if json_path and is_outdated(path, json_path):
+        compile_file(json_path, path)
+    return TypeDB(path)
+
+
+class TypeDBHandle(object):
+    """ The type database a process currently uses. check() looks, at most
+        once per check_interval seconds, for a new version of the file and
+        swaps it in. The swap is a single assignment; whoever holds on to
+        the previous TypeDB can keep using it, its file stays mapped until
+        the last reference is gone.
+
+        json_path is only compiled when the handle is created. Later
+        versions have to be compiled by tools/build_typedb.py, compiling in
+        every worker at once would hold up their requests.
+    """
+
+    def __init__(self, path, json_path=None, check_interval=60):
+        self.path = path
+        self.json_path = json_path
+        self.check_interval = check_interval
+        self.current = load(path, json_path)
+        self._checked_at = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self.current.version
+
+    def is_current(self):
+        try:
+            return file_identity(os.stat(self.path)) == self.current.identity
+        except OSError:
+            # Keep the open version while the file is missing
+            return True
+
+    def reload(self):
+        """ Swaps in the database on disk if it isn't the current one.
+            Returns True if it did.
+        """
+        with self._lock:
+            if self.is_current():
+                return False
+            self.current = TypeDB(self.path)
+            return True
+
+    def check(self):
+        """ Reloads the database if it changed and check_interval passed
+            since the last check. Returns True if it was reloaded.
+        """
+        if time.time() - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = time.time()
+        return self.reload()
+
+    def expire(self):
+        """ Makes the next check() look at the file right away. Safe to call
+            from a signal handler.
+        """
+        self._checked_at = 0
+
+    def __len__(self):
+        return len(self.current)
+
+    def __iter__(self):
+        return iter(self.current)
+
+    def get_by_id(self, typeID):
+        return self.current.get_by_id(typeID)
+
+    def get_by_name(self, name):
+        return self.current.get_by_name(name)
+
+    def is_name_prefix(self, words):
+        return self.current.is_name_prefix(words)
@@ -13,7 +13,8 @@ from sqlalchemy import desc
 
 from evepraisal.api import estimate_retrieve
 from evepraisal.estimate import create_appraisal
-from evepraisal.helpers import login_required, login_required_if_config
+from evepraisal.helpers import (
+    get_requested_markets, login_required, login_required_if_config)
 from evepraisal.models import Appraisals, Users, appraisal_count
 from . import app, db, cache, evesso
 
@@ -25,7 +26,8 @@ def estimate_cost():
     raw_paste = request.form.get('raw_paste', '')
     solar_system = request.form.get('market', '30000142')
 
-    appraisal = create_appraisal(raw_paste, solar_system)
+    appraisal = create_appraisal(raw_paste, solar_system,
+                                 markets=get_requested_markets())
 
     # Yes, this returns a string on exception. I really don't care.
     if not isinstance(appraisal, basestring):
@@ -35,6 +37,15 @@ def estimate_cost():
         return render_template('error.html', error='Error when parsing input: ' + str(appraisal))
 
 
+def request_too_large(error):
+    """ Request bodies over MAX_CONTENT_LENGTH are refused before they are
+        read, the form isn't available to render a page with.
+    """
+    return ('The paste is too large, it can be at most %d KB.' %
+            (app.config['PASTE_MAX_BYTES'] // 1024), 413,
+            {'Content-Type': 'text/plain'})
+
+
 @login_required_if_config
 def display_result(result_id):
     message, status = estimate_retrieve(result_id)
@@ -0,0 +1,105 @@
+""" Keeps the prices of the most appraised types warm in the cache.
+
+    The warmer looks at recent appraisals to learn which types are priced
+    most often in each market and re-fetches them from the providers before
+    their cache entries expire, so that users don't pay provider latency for
+    popular items after a restart or a cache flush. It is meant to run as a
+    single background process, see tools/warm_prices.py.
+"""
+import time
+from collections import Counter, defaultdict
+
+from sqlalchemy import desc
+
+from estimate import get_market_prices, warmed_types_key
+from helpers import pop_shared_stats
+from models import TYPES, Appraisals
+from pricestore import prune
+from . import app, cache, db
+
+
+def get_popular_types(sample_size, top_n):
+    """ Returns {market: [typeId, ...]} with the top_n most frequently
+        priced types per market among the last sample_size appraisals.
+    """
+    counters = defaultdict(Counter)
+    rows = (db.session.query(Appraisals.Market, Appraisals.Prices)
+            .order_by(desc(Appraisals.Created))
+            .limit(sample_size))
+    for market, prices in rows:
+        if market is None or not prices:
+            continue
+        counters[str(market)].update(type_id for type_id, _ in prices)
+
+    return dict((market, [type_id for type_id, _ in
+                          counter.most_common(top_n)])
+                for market, counter in counters.items())
+
+
+def warm_market(market, type_ids, rate):
+    """ Re-fetches prices for type_ids in one market, pricing at most rate
+        types per second. Returns the number of types that got a price.
+    """
+    options = {'solarsystem_id': market, 'refresh': True}
+    batch_size = max(1, int(rate))
+    priced = 0
+    for i in range(0, len(type_ids), batch_size):
+        start = time.time()
+        batch = type_ids[i:i + batch_size]
+        priced += len(get_market_prices(batch, options=options))
+
+        elapsed = time.time() - start
+        if elapsed < 1.0 * len(batch) / rate:
+            time.sleep(1.0 * len(batch) / rate - elapsed)
+
+    cache.set(warmed_types_key(options=options), set(type_ids),
+              timeout=app.config['PRICE_CACHE_TIMEOUT'])
+    return priced
+
+
+def report_coverage():
+    """ Logs, and resets, the share of price cache hits that were served
+        from entries the warmer keeps fresh, next to the hits on types known
+        to have no price.
+    """
+    stats = pop_shared_stats(['price_cache_hits', 'price_cache_warmed_hits',
+                              'negative_cache_hits'])
+    hits = stats['price_cache_hits']
+    warmed_hits = stats['price_cache_warmed_hits']
+    coverage = 100.0 * warmed_hits / hits if hits else 0.0
+    app.logger.info("Price warmer coverage: %s of %s cache hits (%.1f%%), "
+                    "%s negative cache hits", warmed_hits, hits, coverage,
+                    stats['negative_cache_hits'])
+    return coverage
+
+
+def run_cycle():
+    # Every cycle gets its own g, nothing remembered for a request outlives
+    # the cycle
+    with app.app_context():
+        if TYPES.check():
+            app.logger.info("Loaded type database version %s", TYPES.version)
+        popular = get_popular_types(app.config['PRICE_WARMER_SAMPLE'],
+                                    app.config['PRICE_WARMER_TOP_N'])
+        for market, type_ids in popular.items():
+            if market not in app.config['VALID_SOLAR_SYSTEMS']:
+                continue
+            priced = warm_market(market, type_ids,
+                                 app.config['PRICE_WARMER_RATE'])
+            app.logger.info("Warmed %s/%s types for market %s",
+                            priced, len(type_ids), market)
+        app.logger.info("Pruned %s stale price snapshots", prune())
+        db.session.remove()
+
+
+def run_forever():
+    while True:
+        start = time.time()
+        report_coverage()
+        try:
+            run_cycle()
+        except Exception:
+            app.logger.exception("Price warmer cycle failed")
+
+        elapsed = time.time() - start
+        time.sleep(max(0, app.config['PRICE_WARMER_INTERVAL'] - elapsed))
@@ -24,6 +24,8 @@ all_packages = [
         'sqlalchemy',
         'alembic',
         'evepaste',
+        'urllib3',
+        'numpy',
     ]
 
 # no memcached support for windows. deal with it.
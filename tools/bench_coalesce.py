@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# Prices the same paste from many concurrent requests against a local
+# stand-in CREST server and counts how many CREST calls it takes, with and
+# without request coalescing in get_market_prices.
+#
+# Run from the repository root:
+#   python tools/bench_coalesce.py --latency 0.05 --requests 20 --types 50
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crest_standin import CrestHandler, start_server  # NOQA
+from evepraisal import app, cache, httpclient  # NOQA
+from evepraisal.estimate import get_market_prices  # NOQA
+from evepraisal.models import TYPES  # NOQA
+
+
+def burst(type_ids, concurrency):
+    """ Prices type_ids from concurrency threads at once. Returns (seconds,
+        CREST calls, number of requests that priced every type).
+    """
+    complete = []
+    gate = threading.Event()
+
+    def appraise():
+        with app.test_request_context():
+            gate.wait()
+            prices = get_market_prices(type_ids,
+                                       options={'solarsystem_id': '30000142'})
+            if len(prices) == len(type_ids):
+                complete.append(True)
+
+    threads = [threading.Thread(target=appraise) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    requests_before = CrestHandler.request_count
+    start = time.time()
+    gate.set()
+    for thread in threads:
+        thread.join()
+    return (time.time() - start, CrestHandler.request_count - requests_before,
+            len(complete))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--types', type=int, default=50)
+    args = parser.parse_args()
+
+    server = start_server(latency=args.latency)
+    app.config['CREST_URL'] = server.url
+    # Every price has to come from CREST
+    app.config['PRICE_STORE_PATH'] = ''
+    type_ids = [t['typeID'] for t in TYPES if t.get('market')][:args.types]
+
+    print("%10s %10s %12s %10s" % ('coalesce', 'time (s)', 'CREST calls',
+                                   'complete'))
+    for coalesce in [False, True]:
+        app.config['PRICE_COALESCE'] = coalesce
+        with app.app_context():
+            cache.clear()
+        elapsed, calls, complete = burst(type_ids, args.requests)
+        print("%10s %10.3f %12d %7d/%d" % (coalesce, elapsed, calls,
+                                           complete, args.requests))
+
+    httpclient.get_pool().clear()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
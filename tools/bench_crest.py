@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Benchmarks get_market_values_crest against a local stand-in CREST server,
+# comparing one-at-a-time fetching with the bounded concurrent mode.
+#
+# With --bulk it instead ingests a whole region order book (synthetic, or
+# recorded pages with --pages) and checks that pricing pastes afterwards
+# makes no per-type CREST calls.
+#
+# Run from the repository root:
+#   python tools/bench_crest.py --latency 0.05 --sizes 10,50,100,300
+#   python tools/bench_crest.py --bulk --region-types 2000
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crest_standin import CrestHandler, start_server  # NOQA
+from evepraisal import app, httpclient  # NOQA
+from evepraisal.estimate import (  # NOQA
+    get_market_prices, get_market_values_crest, refresh_crest_region)
+from evepraisal.models import TYPES  # NOQA
+
+
+def market_type_ids(count):
+    return [t['typeID'] for t in TYPES if t.get('market')][:count]
+
+
+def timed(type_ids, max_in_flight):
+    app.config['CREST_MAX_IN_FLIGHT'] = max_in_flight
+    start = time.time()
+    prices = get_market_values_crest(type_ids,
+                                     options={'solarsystem_id': '30000142'})
+    return time.time() - start, prices
+
+
+def bench_bulk(sizes, region_types):
+    CrestHandler.region_type_ids = market_type_ids(region_types)
+    app.config['CREST_REGION_BULK'] = True
+    # Leave the other providers out of the picture
+    app.config['PROVIDER_COOLDOWN'] = 3600
+    app.config['PROVIDER_FAILURE_THRESHOLD'] = 1
+    # The in-process cache used in development only holds a few hundred
+    # entries, so let a throwaway price store catch the rest
+    app.config['PRICE_STORE_PATH'] = os.path.join(tempfile.mkdtemp(),
+                                                  'prices.db')
+
+    with app.test_request_context():
+        start = time.time()
+        requests_before = CrestHandler.request_count
+        priced = refresh_crest_region('10000002')
+        print("ingested %d types in %.3fs with %d requests" % (
+            priced, time.time() - start,
+            CrestHandler.request_count - requests_before))
+
+        print("%8s %12s %14s" % ('types', 'pricing (s)', 'CREST calls'))
+        for size in sizes:
+            type_ids = CrestHandler.region_type_ids[:size]
+            requests_before = CrestHandler.request_count
+            start = time.time()
+            prices = get_market_prices(type_ids,
+                                       options={'solarsystem_id': '30000142'})
+            assert len(prices) == len(type_ids), "types left unpriced"
+            print("%8d %12.3f %14d" % (size, time.time() - start,
+                                       CrestHandler.request_count -
+                                       requests_before))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--sizes', default='10,50,100,300')
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    parser.add_argument('--bulk', action='store_true',
+                        help='benchmark region-wide order book ingestion')
+    parser.add_argument('--pages',
+                        help='directory of recorded region order pages')
+    parser.add_argument('--region-types', type=int, default=2000)
+    args = parser.parse_args()
+
+    server = start_server(latency=args.latency, pages_dir=args.pages)
+    app.config['CREST_URL'] = server.url
+
+    if args.bulk:
+        bench_bulk([int(s) for s in args.sizes.split(',')],
+                   args.region_types)
+        httpclient.get_pool().clear()
+        server.shutdown()
+        return
+
+    print("%8s %12s %12s %8s" % ('types', 'serial (s)', 'pooled (s)',
+                                 'speedup'))
+    with app.test_request_context():
+        for size in [int(s) for s in args.sizes.split(',')]:
+            type_ids = market_type_ids(size)
+            serial_time, serial_prices = timed(type_ids, 1)
+            pooled_time, pooled_prices = timed(type_ids, args.max_in_flight)
+            assert serial_prices == pooled_prices, "results differ"
+            print("%8d %12.3f %12.3f %7.1fx" % (
+                size, serial_time, pooled_time, serial_time / pooled_time))
+
+    httpclient.get_pool().clear()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Compares parse time and peak memory of building a full tree for an
+# eve-central marketstat response against the incremental parser used by
+# get_market_values. Each mode runs in a forked child so peak RSS figures
+# don't bleed into each other (Linux only).
+#
+# Run from the repository root, either on a recorded response or on a
+# generated one:
+#   python tools/bench_marketstat.py --file recorded-marketstat.xml
+#   python tools/bench_marketstat.py --types 20000
+
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from evepraisal.estimate import ET, iter_marketstat_types  # NOQA
+
+STAT_TEMPLATE = ('<%(kind)s><volume>%(volume)d</volume>'
+                 '<avg>%(avg).2f</avg><max>%(max).2f</max>'
+                 '<min>%(min).2f</min><stddev>%(stddev).2f</stddev>'
+                 '<median>%(median).2f</median>'
+                 '<percentile>%(percentile).2f</percentile></%(kind)s>')
+
+
+def generate_marketstat(type_count):
+    rand = random.Random(type_count)
+    parts = ['<?xml version="1.0" encoding="utf-8"?>\n'
+             '<evec_api version="2.0" method="marketstat_xml"><marketstat>']
+    for type_id in range(1, type_count + 1):
+        parts.append('<type id="%d">' % type_id)
+        for kind in ['buy', 'sell', 'all']:
+            price = rand.uniform(1, 1000000)
+            parts.append(STAT_TEMPLATE % {
+                'kind': kind, 'volume': rand.randint(1, 100000),
+                'avg': price, 'max': price * 1.1, 'min': price * 0.9,
+                'stddev': price * 0.05, 'median': price,
+                'percentile': price * 1.01})
+        parts.append('</type>')
+    parts.append('</marketstat></evec_api>')
+    return ''.join(parts)
+
+
+def parse_tree(data, solarsystem_id):
+    """ The previous implementation: build the whole tree, then walk it. """
+    market_prices = {}
+    all_price_metric = 'percentile'
+    if solarsystem_id == '-1':
+        buy_price_metric = 'percentile'
+        sell_price_metric = 'percentile'
+    else:
+        buy_price_metric = 'max'
+        sell_price_metric = 'min'
+    for marketstat in ET.fromstring(data).findall("./marketstat/type"):
+        k = int(marketstat.attrib.get('id'))
+        v = {}
+        for stat_type in ['sell', 'buy', 'all']:
+            props = {}
+            for stat in marketstat.find(stat_type):
+                if not stat.tag == "generated":
+                    props[stat.tag] = float(stat.text)
+            v[stat_type] = props
+        v['all']['price'] = v['all'][all_price_metric]
+        v['buy']['price'] = v['buy'][buy_price_metric]
+        v['sell']['price'] = v['sell'][sell_price_metric]
+        v['source'] = 'evecentral'
+        market_prices[k] = v
+    return market_prices
+
+
+def parse_stream(data, solarsystem_id):
+    return dict(iter_marketstat_types(io.BytesIO(data), solarsystem_id))
+
+
+def read_status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def measure(func, data):
+    """ Runs func in a forked child and returns (seconds, peak RSS growth in
+        KB, number of priced types).
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        # Reset the peak RSS counter so only the parse is measured
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        base = read_status_kb('VmRSS')
+        start = time.time()
+        prices = func(data, '30000142')
+        elapsed = time.time() - start
+        peak = read_status_kb('VmHWM') - base
+        os.write(write_fd, '%f %d %d' % (elapsed, peak, len(prices)))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 1024).split()
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return float(result[0]), int(result[1]), int(result[2])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', help='recorded marketstat response')
+    parser.add_argument('--types', type=int, default=20000,
+                        help='types to generate when no file is given')
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            data = f.read()
+    else:
+        data = generate_marketstat(args.types)
+
+    assert parse_tree(data, '30000142') == parse_stream(data, '30000142'), \
+        "results differ"
+
+    print("document size: %.1f MB" % (len(data) / 1024.0 / 1024.0))
+    print("%8s %10s %14s %8s" % ('mode', 'time (s)', 'peak RSS (MB)',
+                                 'types'))
+    for name, func in [('tree', parse_tree), ('stream', parse_stream)]:
+        elapsed, peak, count = measure(func, data)
+        print("%8s %10.3f %14.1f %8d" % (name, elapsed, peak / 1024.0,
+                                         count))
+
+
+if __name__ == '__main__':
+    main()
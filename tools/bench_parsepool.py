@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Measures the throughput of parser.parse_chunked on big listing pastes and
+# on noisy pastes that end up with tryhard_parser, parsed in the web worker
+# and in parse pools of a growing number of processes. Pools are started,
+# and their processes have loaded the types, before they are timed, as they
+# are in a web worker that has parsed a big paste before. The totals must
+# be the same in every mode. Scaling stops at the number of cores.
+#
+# Run from the repository root:
+#   python tools/bench_parsepool.py --lines 50000 --processes 1 2 4 8
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from evepraisal import app, parser, parsepool  # NOQA
+from evepraisal.helpers import iter_lines  # NOQA
+from evepraisal.models import TYPES  # NOQA
+from bench_parsers import generate_paste as generate_noisy_paste  # NOQA
+from bench_stream import totals  # NOQA
+
+
+def generate_listing_paste(line_count, seed=42):
+    rand = random.Random(seed)
+    names = [t.typeName for t in TYPES if t.market]
+    lines = []
+    for _ in range(line_count):
+        name = rand.choice(names)
+        quantity = rand.randint(1, 5000)
+        if rand.random() < 0.5:
+            lines.append(rand.choice(['%s x %d', '%s %d']) % (name, quantity))
+        else:
+            lines.append('%d x %s' % (quantity, name))
+    return lines
+
+
+def timed(raw_paste, parallel):
+    with app.test_request_context('/'):
+        start = time.time()
+        parsed = parser.parse_chunked(iter_lines(raw_paste),
+                                      parallel=parallel)
+        return time.time() - start, parsed
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--lines', type=int, default=50000)
+    argparser.add_argument('--processes', type=int, nargs='+',
+                           default=[1, 2, 4, 8])
+    args = argparser.parse_args()
+
+    pastes = []
+    for name, generate in [('listing', generate_listing_paste),
+                           ('noisy', generate_noisy_paste)]:
+        pastes.append((name, u'\n'.join(generate(args.lines))))
+
+    print("%d cores" % multiprocessing.cpu_count())
+    print("%8s %10s %10s %12s %10s" % (
+        'paste', 'processes', 'time (s)', 'lines/s', 'speedup'))
+    for name, raw_paste in pastes:
+        base_time, base = timed(raw_paste, False)
+        print("%8s %10s %10.3f %12d %9.1fx" % (
+            name, 'none', base_time, args.lines / base_time, 1))
+        for processes in args.processes:
+            app.config['PARSE_POOL_PROCESSES'] = processes
+            parsepool.reset()
+            list(parsepool.imap(len, [[]] * processes))
+            elapsed, parsed = timed(raw_paste, True)
+            assert totals(parsed) == totals(base), "totals differ"
+            print("%8s %10d %10.3f %12d %9.1fx" % (
+                name, processes, elapsed, args.lines / elapsed,
+                base_time / elapsed))
+    parsepool.reset()
+
+
+if __name__ == '__main__':
+    main()
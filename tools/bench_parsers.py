@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Compares listing_parser and tryhard_parser with their previous
+# implementations, which looked a line up once per word prefix, on a noisy
+# generated paste: listings mixed with lines that have junk after the type
+# name and chat-like lines without any type at all.
+#
+# Run from the repository root:
+#   python tools/bench_parsers.py --lines 10000
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from evepaste import parsers  # NOQA
+from evepraisal.models import TYPES, get_type_by_name  # NOQA
+from evepraisal.parser import (listing_parser, tryhard_parser,  # NOQA
+                               int_convert)
+
+JUNK = ('the of and fleet undock warp to gate station we need more fits for '
+        'tonight lol anyone selling cheap in jita local is red bring your '
+        'own ammo and drones align now').split()
+
+
+def old_listing_parser(lines):
+    """ The previous implementation. """
+    results = defaultdict(int)
+    bad_lines = []
+    lines = [line.strip() for line in lines]
+    for line in lines:
+        if get_type_by_name(line):
+            results[line] += 1
+        else:
+            result, bad_line = parsers.parse_listing([line])
+            for r in result:
+                if get_type_by_name(r['name']):
+                    results[r['name']] += r.get('quantity', 1)
+                else:
+                    bad_lines.append(line)
+            for l in bad_line:
+                bad_lines.append(l)
+
+    return [{'name': name, 'quantity': quantity}
+            for name, quantity in results.items()], bad_lines
+
+
+def old_tryhard_parser(lines):
+    """ The previous implementation. """
+    results = defaultdict(int)
+    bad_lines = []
+
+    for line in lines:
+        parts = [part.strip(', ') for part in line.split('\t')]
+        if len(parts) == 1:
+            parts = [part.strip(',\t ') for part in line.split('  ')]
+            parts = [part for part in parts if part]
+
+        if len(parts) == 1:
+            parts = [part.strip(',') for part in line.split(' ')]
+            parts = [part for part in parts if part]
+
+        if len(parts) == 1:
+            break
+
+        combinations = [['name', 'quantity'],
+                        [None, 'name', None, 'quantity'],
+                        ['quantity', None, 'name'],
+                        ['quantity', 'name'],
+                        [None, 'name'],
+                        ['name']]
+        for combo in combinations:
+            if len(combo) > len(parts):
+                continue
+
+            name = ''
+            quantity = 1
+            for i, part in enumerate(combo):
+                if part == 'name':
+                    if get_type_by_name(parts[i]):
+                        name = parts[i]
+                    else:
+                        break
+                elif part == 'quantity':
+                    if int_convert(parts[i]):
+                        quantity = int_convert(parts[i])
+                    else:
+                        break
+            else:
+                results[name] += quantity
+                break
+        else:
+            parts = [part.strip(',\t ') for part in line.split(' ')]
+            for i in range(len(parts)):
+                name = ' '.join(parts[:-i])
+                if name and get_type_by_name(name):
+                    results[name] += 1
+                    break
+            else:
+                bad_lines.append(line)
+
+    return [{'name': name, 'quantity': quantity}
+            for name, quantity in results.items()], bad_lines
+
+
+def generate_paste(line_count, seed=42):
+    rand = random.Random(seed)
+    names = [t.typeName for t in TYPES if t.market]
+    # Chat lines often mention the first word of a type name
+    first_words = list(set(name.split()[0] for name in names))
+    lines = []
+    for _ in range(line_count):
+        kind = rand.random()
+        name = rand.choice(names)
+        quantity = rand.randint(1, 5000)
+        if kind < 0.15:
+            lines.append(rand.choice(['%s x%d', '%s %d', '%s x %d']) %
+                         (name, quantity))
+        elif kind < 0.3:
+            lines.append(rand.choice(['%d x %s', '%dx %s']) %
+                         (quantity, name))
+        elif kind < 0.45:
+            junk = ' '.join(rand.choice(JUNK)
+                            for _ in range(rand.randint(3, 12)))
+            lines.append('%s %s' % (name, junk))
+        else:
+            words = [rand.choice(JUNK) for _ in range(rand.randint(8, 40))]
+            if rand.random() < 0.5:
+                words.insert(0, rand.choice(first_words))
+            lines.append(' '.join(words))
+    return lines
+
+
+def normalized(result):
+    items, bad_lines = result
+    totals = defaultdict(int)
+    for item in items:
+        totals[item['name'].strip()] += item['quantity']
+    return dict(totals), sorted(bad_lines)
+
+
+def timed(func, lines):
+    start = time.time()
+    result = func(lines)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=10000)
+    args = parser.parse_args()
+
+    lines = generate_paste(args.lines)
+    print("%10s %10s %10s %10s %8s %10s" % (
+        'parser', 'old (s)', 'new (s)', 'speedup', 'types', 'bad lines'))
+    for name, old, new in [('listing', old_listing_parser, listing_parser),
+                           ('heuristic', old_tryhard_parser, tryhard_parser)]:
+        old_time, old_result = timed(old, lines)
+        new_time, new_result = timed(new, lines)
+        old_items, old_bad = normalized(old_result)
+        new_items, new_bad = normalized(new_result)
+        assert (old_items, old_bad) == (new_items, new_bad), \
+            "results differ"
+        print("%10s %10.3f %10.3f %9.1fx %8d %10d" % (
+            name, old_time, new_time, old_time / new_time, len(new_items),
+            len(new_bad)))
+
+
+if __name__ == '__main__':
+    main()
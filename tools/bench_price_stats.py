@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Compares the batched NumPy order book statistics used for CREST prices
+# against the previous pure Python implementation, checking that both give
+# the same results and timing them on synthetic order books.
+#
+# Run from the repository root:
+#   python tools/bench_price_stats.py --types 300 --orders 200
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from evepraisal.estimate import summarize_crest_orders  # NOQA
+
+
+def legacy_price_volume_statistics(pricevolumedict):
+    """ The previous pure Python implementation, kept as the reference. """
+    pricevolumedict = sorted(pricevolumedict, key=lambda k: k['price'])
+    if len(pricevolumedict) == 0:
+        return {'avg': 0, 'max': 0, 'min': 0, 'bottom5pct': 0, 'top5pct': 0, 'volume': 0}
+
+    maxprice = pricevolumedict[0]['price']
+    minprice = pricevolumedict[0]['price']
+    totalvolume = 0
+    totalprice = 0
+
+    for item in pricevolumedict:
+        totalvolume += item['volume']
+        totalprice += (item['price'] * item['volume'])
+        minprice = min(minprice, item['price'])
+        maxprice = max(maxprice, item['price'])
+
+    fivepctvolume = totalvolume * 0.05
+    currentvolume = 0.00
+    top5pct = 0.00
+    bottom5pct = 0.00
+    volumetouse = 0.00
+
+    for item in pricevolumedict:
+        if currentvolume < fivepctvolume:
+            if (currentvolume + item['volume']) <= fivepctvolume:
+                volumetouse = item['volume']
+            else:
+                volumetouse = fivepctvolume - currentvolume
+            bottom5pct += (item['price'] * volumetouse)
+
+        if (currentvolume + item['volume']) > (totalvolume - fivepctvolume):
+            if currentvolume > (totalvolume - fivepctvolume):
+                volumetouse = item['volume']
+            else:
+                volumetouse = ((currentvolume + item['volume']) - (totalvolume - fivepctvolume))
+            top5pct += (item['price'] * volumetouse)
+
+        currentvolume = currentvolume + item['volume']
+
+    avg = totalprice / totalvolume
+    bottom5pct = bottom5pct / fivepctvolume
+    top5pct = top5pct / fivepctvolume
+
+    return {
+        "avg": avg,
+        "max": maxprice,
+        "min": minprice,
+        "bottom5pct": bottom5pct,
+        "top5pct": top5pct,
+        "volume": totalvolume
+    }
+
+
+def legacy_summarize(orders):
+    buy = []
+    sell = []
+    all = []
+    for item in orders:
+        row = {"volume": item["volume"], "price": item["price"]}
+        if item["buy"]:
+            buy.append(row)
+        else:
+            sell.append(row)
+        all.append(row)
+
+    output_all = legacy_price_volume_statistics(all)
+    output_buy = legacy_price_volume_statistics(buy)
+    output_sell = legacy_price_volume_statistics(sell)
+    output = {"source": "crest"}
+    for side, stats in [('all', output_all), ('buy', output_buy),
+                        ('sell', output_sell)]:
+        output[side] = {"avg": stats['avg'], "max": stats['max'],
+                        "min": stats['min'], "volume": stats['volume']}
+    output["all"]["price"] = output_all['avg']
+    output["buy"]["price"] = output_buy['top5pct']
+    output["sell"]["price"] = output_sell['bottom5pct']
+    return output
+
+
+def generate_orders(type_count, order_count):
+    rand = random.Random(type_count * order_count)
+    orders_by_type = {}
+    for type_id in range(1, type_count + 1):
+        base = rand.uniform(1, 1000000)
+        orders_by_type[type_id] = [
+            {'buy': rand.random() < 0.4,
+             'price': round(base * rand.uniform(0.5, 1.5), 2),
+             'volume': rand.randint(1, 100000)}
+            for _ in range(rand.randint(0, order_count))]
+    return orders_by_type
+
+
+def assert_close(expected, actual, path=''):
+    if isinstance(expected, dict):
+        assert sorted(expected) == sorted(actual), path
+        for key in expected:
+            assert_close(expected[key], actual[key], '%s/%s' % (path, key))
+    elif isinstance(expected, float):
+        assert abs(expected - actual) <= 1e-9 * max(1.0, abs(expected)), \
+            '%s: %r != %r' % (path, expected, actual)
+    else:
+        assert expected == actual, '%s: %r != %r' % (path, expected, actual)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--types', type=int, default=300)
+    parser.add_argument('--orders', type=int, default=200,
+                        help='maximum orders per type')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    orders_by_type = generate_orders(args.types, args.orders)
+    order_count = sum(len(orders) for orders in orders_by_type.values())
+
+    start = time.time()
+    for _ in range(args.repeat):
+        expected = dict((type_id, legacy_summarize(orders))
+                        for type_id, orders in orders_by_type.items())
+    legacy_time = (time.time() - start) / args.repeat
+
+    start = time.time()
+    for _ in range(args.repeat):
+        actual = summarize_crest_orders(orders_by_type)
+    batched_time = (time.time() - start) / args.repeat
+
+    assert_close(expected, actual)
+    print("%d types, %d orders: python %.4fs, numpy %.4fs (%.1fx)" % (
+        args.types, order_count, legacy_time, batched_time,
+        legacy_time / batched_time))
+
+
+if __name__ == '__main__':
+    main()
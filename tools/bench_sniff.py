@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Counts the parser attempts made by parser.parse_paste, and times it, with
+# and without format sniffing, for a paste of every supported format. Each
+# paste is repeated to --lines lines, so that failed attempts cost what they
+# do on a big paste. Results must be the same in both modes, for those
+# pastes and for --mixed short pastes that mix lines of random formats.
+#
+# Run from the repository root:
+#   python tools/bench_sniff.py --lines 2000 --mixed 3000
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import evepaste  # NOQA
+from evepraisal import app, parser  # NOQA
+
+PASTES = [
+    ('eft', ['[Rifter, Tackle]'],
+     ['Damage Control II', '200mm AutoCannon II, EMP S', '[empty rig slot]']),
+    ('killmail', ['2013.07.22 02:53', '', 'Victim: Some Pilot',
+                  'Corp: Some Corp', 'Alliance: None', 'Faction: None',
+                  'Destroyed: Rifter', 'System: Jita', 'Security: 0.9',
+                  'Damage Taken: 100', '', 'Involved parties:', '',
+                  'Name: Other Pilot (laid the final blow)',
+                  'Security: 0.0', 'Corp: Other Corp', 'Alliance: None',
+                  'Faction: None', 'Ship: Rifter', 'Weapon: Rifter',
+                  'Damage Done: 100', '', 'Destroyed items:', ''],
+     ['Damage Control II', '200mm AutoCannon II, Qty: 2']),
+    ('dscan', [], ['Rifter\tSome Pilot\'s Rifter\t1,000 km',
+                   'Tritanium\tTritanium\t-']),
+    ('listing', [], ['Tritanium 100', 'Pyerite x 5']),
+    ('cargo_scan', [], ['100 Tritanium', '5 Pyerite']),
+    ('contract', [], ['Tritanium\t100\tMineral\tMaterial\t',
+                      'Rifter\t1\tFrigate\tShip\tFitted']),
+    ('view_contents', [], ['Rifter\tFrigate\tCargo Hold\t1',
+                           'Tritanium\tMineral\tCargo Hold\t100']),
+    ('wallet', [], ['2014.01.01 10:10\tTritanium\t5.00 ISK\t100\t'
+                    '-500.00 ISK\tISK\tSome Pilot\tJita IV - Moon 4']),
+    ('pi', [], ['100\tTritanium\tRouted', '5\tPyerite\tNot routed']),
+    ('survey_scanner', [], ['Veldspar\t1,000\t5,000 m',
+                            'Scordite\t2,000\t12 km']),
+    ('loot_history', [], ['10:10:10 Some Pilot has looted 5 x Tritanium']),
+    ('industry', [], ['Tritanium (100 Units)', 'Pyerite (5 Units)']),
+    ('heuristic', [], ['Rifter junk 5 more junk', 'Tritanium lol 100 x']),
+]
+
+
+def count_attempts(parser_list):
+    """ Wraps the parsers to count their calls in a Counter. """
+    counts = Counter()
+
+    def counting(kind, func):
+        def wrapped(lines):
+            counts[kind] += 1
+            return func(lines)
+        return wrapped
+    return counts, [(kind, counting(kind, func))
+                    for kind, func in parser_list]
+
+
+def run(raw_paste, sniff):
+    app.config['PARSE_SNIFF'] = sniff
+    table = evepaste.PARSER_TABLE
+    listing_parser, tryhard_parser = parser.listing_parser, parser.tryhard_parser
+    counts, wrapped = count_attempts(
+        table + [('listing', listing_parser), ('heuristic', tryhard_parser)])
+    evepaste.PARSER_TABLE = wrapped[:-2]
+    parser.listing_parser = wrapped[-2][1]
+    parser.tryhard_parser = wrapped[-1][1]
+    try:
+        start = time.time()
+        result = parser.parse_paste(raw_paste)
+        elapsed = time.time() - start
+    finally:
+        evepaste.PARSER_TABLE = table
+        parser.listing_parser = listing_parser
+        parser.tryhard_parser = tryhard_parser
+    return result, sum(counts.values()), elapsed
+
+
+def outcome(raw_paste, sniff):
+    """ Returns the result of parsing raw_paste, or the type of the error it
+        raised.
+    """
+    try:
+        return run(raw_paste, sniff)[0]
+    except Exception as e:
+        return type(e)
+
+
+def generate_mixed_pastes(count, seed=42):
+    rand = random.Random(seed)
+    lines = [line for _, header, body in PASTES
+             for line in header + body if line]
+    for _ in range(count):
+        yield '\n'.join(rand.choice(lines)
+                         for _ in range(rand.randint(2, 6)))
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--lines', type=int, default=2000)
+    argparser.add_argument('--mixed', type=int, default=3000)
+    args = argparser.parse_args()
+
+    print("%15s %15s %10s %10s %10s %10s" % (
+        'format', 'parsed as', 'attempts', 'sniffed', 'time (s)',
+        'sniffed (s)'))
+    with app.test_request_context('/'):
+        for name, header, body in PASTES:
+            lines = list(header)
+            while len(lines) < args.lines:
+                lines.extend(body)
+            raw_paste = '\n'.join(lines)
+
+            full, full_attempts, full_time = run(raw_paste, False)
+            sniffed, sniffed_attempts, sniffed_time = run(raw_paste, True)
+            assert full == sniffed, "results differ for %s" % name
+            print("%15s %15s %10d %10d %10.3f %10.3f" % (
+                name, sniffed['representative_kind'], full_attempts,
+                sniffed_attempts, full_time, sniffed_time))
+
+        differ = 0
+        for raw_paste in generate_mixed_pastes(args.mixed):
+            if outcome(raw_paste, False) != outcome(raw_paste, True):
+                differ += 1
+                print("results differ for %r" % raw_paste)
+        assert not differ, "results differ for %d mixed pastes" % differ
+        print("%d mixed pastes, same results" % args.mixed)
+
+
+if __name__ == '__main__':
+    main()
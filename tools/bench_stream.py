@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Compares parser.parse_paste, which parses a paste as a whole, with
+# parser.parse_chunked on big generated listing, cargo scan and contract
+# pastes. Each mode runs in a forked child that reports its time and how
+# much its peak RSS grew while parsing, read from /proc/self (Linux only).
+# The priced totals, quantity per type, must be the same in both modes.
+#
+# Run from the repository root:
+#   python tools/bench_stream.py --lines 50000
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from evepraisal import app, parser  # NOQA
+from evepraisal.helpers import iter_lines, iter_types  # NOQA
+from evepraisal.models import TYPES, get_type_by_name  # NOQA
+
+FORMATS = [
+    ('listing', lambda name, quantity: '%s x %d' % (name, quantity)),
+    ('cargo_scan', lambda name, quantity: '%d %s' % (quantity, name)),
+    ('contract', lambda name, quantity: '%s\t%d\tGroup\tCategory\t' % (
+        name, quantity)),
+]
+
+
+def generate_paste(line_count, line_format, seed=42):
+    rand = random.Random(seed)
+    names = [t.typeName for t in TYPES if t.market][:2000]
+    return u'\n'.join(line_format(rand.choice(names), rand.randint(1, 5000))
+                      for _ in range(line_count))
+
+
+def read_hwm_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+
+def reset_hwm():
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def totals(parsed):
+    quantities = defaultdict(int)
+    for kind, result in parsed['results']:
+        for item in iter_types(kind, result):
+            details = get_type_by_name(item['name'])
+            if details:
+                quantities[details['typeID']] += item['quantity']
+    return sorted(quantities.items())
+
+
+def run(mode, raw_paste):
+    with app.test_request_context('/'):
+        reset_hwm()
+        start_kb = read_hwm_kb()
+        start = time.time()
+        if mode == 'chunked':
+            parsed = parser.parse_chunked(iter_lines(raw_paste))
+        else:
+            parsed = parser.parse_paste(raw_paste)
+        elapsed = time.time() - start
+        grown_kb = read_hwm_kb() - start_kb
+        return {'time': elapsed, 'grown_kb': grown_kb,
+                'kind': parsed['representative_kind'],
+                'totals': totals(parsed)}
+
+
+def measure(mode, raw_paste):
+    """ Runs a mode in a forked child, so modes don't share anything. """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.write(write_fd, json.dumps(run(mode, raw_paste)))
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = json.loads(f.read())
+    os.waitpid(pid, 0)
+    return result
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--lines', type=int, default=50000)
+    args = argparser.parse_args()
+
+    print("%12s %12s %10s %10s %12s %12s" % (
+        'format', 'parsed as', 'whole (s)', 'chunked (s)', 'whole (MB)',
+        'chunked (MB)'))
+    for name, line_format in FORMATS:
+        raw_paste = generate_paste(args.lines, line_format)
+        whole = measure('whole', raw_paste)
+        chunked = measure('chunked', raw_paste)
+        assert whole['totals'] == chunked['totals'], \
+            "totals differ for %s" % name
+        print("%12s %12s %10.3f %10.3f %12.1f %12.1f" % (
+            name, chunked['kind'], whole['time'], chunked['time'],
+            whole['grown_kb'] / 1024.0, chunked['grown_kb'] / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
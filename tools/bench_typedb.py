@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Compares loading data/types.json into dicts, the way models.py used to,
+# with opening the compiled type database: load time, memory and lookup
+# speed. Each mode runs in a forked child so the figures don't bleed into
+# each other (Linux only). Private memory is RssAnon; pages of the mapped
+# database are file backed and shared by every worker.
+#
+# Run from the repository root after tools/build_typedb.py:
+#   python tools/bench_typedb.py --lookups 100000
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'evepraisal'))
+
+import typedb  # NOQA
+
+
+class JSONTypes(object):
+    """ The previous implementation. """
+
+    def __init__(self, json_path):
+        types = json.loads(open(json_path).read())
+        typedb.update_types_repackaged(types)
+        self.by_name = dict((t['typeName'].lower(), t) for t in types)
+        self.by_id = dict((t['typeID'], t) for t in types)
+
+    def get_by_name(self, name):
+        return self.by_name.get(name.lower())
+
+    def get_by_id(self, typeID):
+        return self.by_id.get(typeID)
+
+
+def read_status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def measure(load, names, ids):
+    """ Runs load() and the lookups in a forked child. Returns (load
+        seconds, lookup seconds, RSS growth KB, private RSS growth KB).
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        rss, anon = read_status_kb('VmRSS'), read_status_kb('RssAnon')
+        start = time.time()
+        db = load()
+        loaded = time.time()
+        for name in names:
+            db.get_by_name(name)
+        for type_id in ids:
+            db.get_by_id(type_id)
+        done = time.time()
+        os.write(write_fd, '%f %f %d %d' % (
+            loaded - start, done - loaded, read_status_kb('VmRSS') - rss,
+            read_status_kb('RssAnon') - anon))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 1024).split()
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return float(result[0]), float(result[1]), int(result[2]), int(result[3])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', default='data/types.json')
+    parser.add_argument('--db', default='data/types.db')
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    if typedb.is_outdated(args.db, args.json):
+        typedb.compile_file(args.json, args.db)
+
+    types = json.load(open(args.json))
+    rand = random.Random(42)
+    sample = [rand.choice(types) for _ in range(args.lookups)]
+    names = [t['typeName'].lower() for t in sample]
+    ids = [t['typeID'] for t in sample]
+    del types, sample
+
+    print("%8s %10s %14s %10s %13s" % ('mode', 'load (s)', 'lookups (s)',
+                                       'RSS (MB)', 'private (MB)'))
+    for mode, load in [('json', lambda: JSONTypes(args.json)),
+                       ('typedb', lambda: typedb.TypeDB(args.db))]:
+        load_time, lookup_time, rss, anon = measure(load, names, ids)
+        print("%8s %10.3f %14.3f %10.1f %13.1f" % (
+            mode, load_time, lookup_time, rss / 1024.0, anon / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
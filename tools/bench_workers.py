@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# Measures the memory held by each worker of a preforking server (gunicorn,
+# uWSGI) for the types, with the types loaded the way models.py used to, as
+# dicts parsed from data/types.json, and with the mapped type database.
+# Types are loaded in the master before the workers are forked. Each worker
+# then looks up every type once, like a long running worker eventually
+# does, and reports its RSS, its proportional share of shared pages (PSS)
+# and its private memory, all read from /proc/self/smaps_rollup (Linux
+# only). Reference counting writes to every dict a worker touches, so dicts
+# inherited from the master end up copied into each worker.
+#
+# Run from the repository root after tools/build_typedb.py:
+#   python tools/bench_workers.py --workers 8 16
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'evepraisal'))
+
+import typedb  # NOQA
+from bench_typedb import JSONTypes  # NOQA
+
+
+def read_rollup_kb():
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return fields
+
+
+def work(db, names, ids):
+    for name in names:
+        details = db.get_by_name(name)
+        item = {'name': name, 'quantity': 1}
+        item['volume'] = details['volume'] * item['quantity']
+    for type_id in ids:
+        db.get_by_id(type_id)['typeName']
+
+
+def run_worker(db, names, ids, ready_fd, go_fd, result_fd):
+    work(db, names, ids)
+    os.write(ready_fd, 'x')
+    # Wait until every worker is done so that shared pages are measured
+    # while all of them are alive
+    os.read(go_fd, 1)
+    rollup = read_rollup_kb()
+    os.write(result_fd, '%d %d %d\n' % (
+        rollup['Rss'], rollup['Pss'],
+        rollup['Private_Clean'] + rollup['Private_Dirty']))
+    os._exit(0)
+
+
+def run_master(load, workers, names, ids):
+    """ Loads the types, forks the workers and returns [(RSS, PSS,
+        private), ...] in KB, one per worker.
+    """
+    db = load()
+    ready_r, ready_w = os.pipe()
+    go_r, go_w = os.pipe()
+    result_r, result_w = os.pipe()
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(go_w)
+            run_worker(db, names, ids, ready_w, go_r, result_w)
+        pids.append(pid)
+
+    os.close(ready_w)
+    os.close(go_r)
+    os.close(result_w)
+    for _ in range(workers):
+        os.read(ready_r, 1)
+    os.close(go_w)
+    with os.fdopen(result_r) as f:
+        results = [tuple(int(v) for v in line.split()) for line in f]
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return results
+
+
+def measure(load, workers, names, ids):
+    """ Runs a master in a forked child, so modes don't share anything. """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        results = run_master(load, workers, names, ids)
+        os.write(write_fd, json.dumps(results))
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        results = json.loads(f.read())
+    os.waitpid(pid, 0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', default='data/types.json')
+    parser.add_argument('--db', default='data/types.db')
+    parser.add_argument('--workers', type=int, nargs='+', default=[8, 16])
+    args = parser.parse_args()
+
+    if typedb.is_outdated(args.db, args.json):
+        typedb.compile_file(args.json, args.db)
+
+    types = json.load(open(args.json))
+    random.Random(42).shuffle(types)
+    names = [t['typeName'].lower() for t in types]
+    ids = [t['typeID'] for t in types]
+    del types
+
+    print("%8s %8s %10s %10s %14s %14s" % (
+        'mode', 'workers', 'RSS (MB)', 'PSS (MB)', 'private (MB)',
+        'total PSS (MB)'))
+    for workers in args.workers:
+        for mode, load in [('json', lambda: JSONTypes(args.json)),
+                           ('typedb', lambda: typedb.TypeDB(args.db))]:
+            results = measure(load, workers, names, ids)
+            rss, pss, private = [sum(r[i] for r in results) / 1024.0
+                                 for i in range(3)]
+            print("%8s %8d %10.1f %10.1f %14.1f %14.1f" % (
+                mode, workers, rss / workers, pss / workers,
+                private / workers, pss))
+
+
+if __name__ == '__main__':
+    main()
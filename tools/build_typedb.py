@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# Compiles data/types.json into the binary type database the app maps into
+# memory (see evepraisal/typedb.py). Run it after updating types.json:
+#   python tools/build_typedb.py
+#   python tools/build_typedb.py --input data/types.json --output data/types.db
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'evepraisal'))
+
+import typedb  # NOQA
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default='data/types.json')
+    parser.add_argument('--output', default='data/types.db')
+    args = parser.parse_args()
+
+    start = time.time()
+    typedb.compile_file(args.input, args.output)
+    db = typedb.TypeDB(args.output)
+    print("Compiled %d types to %s (%.1f MB) in %.2fs" % (
+        len(db), args.output, os.path.getsize(args.output) / 1024.0 / 1024.0,
+        time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# A local stand-in for the EVE CREST market endpoints. It serves synthetic
+# order books with a configurable latency so the pricing code can be
+# exercised and benchmarked without touching the real API.
+#
+# The region-wide /market/<region>/orders/all/ endpoint is paginated. It
+# serves recorded pages from --pages (as <dir>/<region>/<page>.json) when
+# given, or synthetic pages for --region-types types otherwise.
+#
+# Run on its own with:
+#   python tools/crest_standin.py --port 8089 --latency 0.05
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+TYPE_URL_RE = re.compile(r'/inventory/types/(\d+)/?$')
+ORDERS_PATH_RE = re.compile(r'^/market/(\d+)/orders/$')
+ALL_ORDERS_PATH_RE = re.compile(r'^/market/(\d+)/orders/all/$')
+PAGE_SIZE = 1000
+
+
+def build_orders(region_id, type_id, count=40):
+    """ Returns a deterministic list of CREST style orders for a type. """
+    rand = random.Random('%s:%s' % (region_id, type_id))
+    base_price = rand.uniform(10, 10000000)
+    orders = []
+    for i in range(count):
+        buy = i % 3 == 0
+        spread = rand.uniform(0.7, 1.0) if buy else rand.uniform(1.0, 1.4)
+        orders.append({
+            'buy': buy,
+            'price': round(base_price * spread, 2),
+            'volume': rand.randint(1, 5000),
+            'type': {'id': type_id},
+        })
+    return orders
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on kept-alive connections is expected here.
+        pass
+
+
+class CrestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.0
+    request_count = 0
+    pages_dir = None
+    region_type_ids = range(1, 1001)
+    region_items = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with CrestHandler.lock:
+            CrestHandler.request_count += 1
+
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        match = ALL_ORDERS_PATH_RE.match(url.path)
+        if match:
+            self.send_region_page(int(match.group(1)),
+                                  int(query.get('page', ['1'])[0]))
+            return
+
+        match = ORDERS_PATH_RE.match(url.path)
+        type_match = TYPE_URL_RE.search(query.get('type', [''])[0])
+        if not match or not type_match:
+            self.send_error(404)
+            return
+
+        time.sleep(self.latency)
+        region_id = int(match.group(1))
+        type_id = int(type_match.group(1))
+        items = build_orders(region_id, type_id)
+        body = json.dumps({'items': items, 'totalCount': len(items),
+                           'pageCount': 1})
+        self.send_json(body)
+
+    def send_region_page(self, region_id, page):
+        time.sleep(self.latency)
+        if self.pages_dir:
+            path = os.path.join(self.pages_dir, str(region_id),
+                                '%s.json' % page)
+            if not os.path.exists(path):
+                self.send_error(404)
+                return
+            with open(path) as f:
+                self.send_json(f.read())
+            return
+
+        items = self.region_items.get(region_id)
+        if items is None:
+            items = []
+            for type_id in self.region_type_ids:
+                for order in build_orders(region_id, type_id):
+                    order['type'] = type_id
+                    items.append(order)
+            self.region_items[region_id] = items
+        page_count = max(1, (len(items) + PAGE_SIZE - 1) // PAGE_SIZE)
+        if page > page_count:
+            self.send_error(404)
+            return
+        page_items = items[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        self.send_json(json.dumps({'items': page_items,
+                                   'totalCount': len(items),
+                                   'pageCount': page_count}))
+
+    def send_json(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(port=0, latency=0.0, handler=CrestHandler, pages_dir=None):
+    """ Starts the stand-in server on a background thread and returns it.
+        The base URL is available as server.url.
+    """
+    handler.latency = latency
+    handler.pages_dir = pages_dir
+    server = ThreadedHTTPServer(('127.0.0.1', port), handler)
+    server.url = 'http://127.0.0.1:%s' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds to wait before answering')
+    parser.add_argument('--pages',
+                        help='directory of recorded region order pages')
+    parser.add_argument('--region-types', type=int, default=1000,
+                        help='types in synthetic region order books')
+    args = parser.parse_args()
+
+    CrestHandler.region_type_ids = range(1, args.region_types + 1)
+    server = start_server(args.port, args.latency, pages_dir=args.pages)
+    print("Serving stand-in CREST on %s" % server.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,30 @@
 #!/usr/bin/env python
 # This is a script intended to be ran only when there are updates to the item
 # database. The results are dumped into a file as JSON to be read by the app.
+#
+# Types are read from a local copy of the SDE sqlite dump (plain or .bz2)
+# given with --sde, or from the latest dump on fuzzwork.co.uk otherwise, and
+# written out one type per line as they are read. With --incremental the
+# current output is compared with the new types: a changelog of added,
+# removed, renamed and changed types is printed (or written to
+# --changelog), types that didn't change keep their line as is and the file
+# isn't touched at all when nothing changed.
+#
+#   python tools/populate_types.py --sde sqlite-latest.sqlite.bz2 \
+#       --incremental --changelog types-changelog.txt
 
 from __future__ import print_function
 
+import argparse
 import bz2
-import collections
 import json
 import os
 import shutil
 import sqlite3
 import tempfile
+import time
 import urllib2
+from collections import defaultdict
 
 # from reverence import blue, const
 
@@ -25,41 +38,62 @@ COMP_TYPES = [
 
 SQLITE_DUMP_URL = "https://www.fuzzwork.co.uk/dump/sqlite-latest.sqlite.bz2"
 
+CHUNK_SIZE = 1000000  # 1 megabyte at a time
 
-def download_database(destination_path):
-    decompressor = bz2.BZ2Decompressor()
-    response = urllib2.urlopen(SQLITE_DUMP_URL)
 
-    total_bytes = int(response.info().getheader('Content-Length').strip())
-    chunk = 1000000  # 1 megabyte at a time
+def decompress_database(source, destination_path, total_bytes=None):
+    """ Decompresses a bz2 compressed SDE read from the file like source. """
+    decompressor = bz2.BZ2Decompressor()
     bytes_read = 0
     with open(destination_path, 'wb') as f:
         while 1:
-            data = response.read(chunk)
+            data = source.read(CHUNK_SIZE)
             if not data:
                 break
 
             bytes_read += len(data)
-            print("Progress: %d of %d bytes (%0.2f%% complete)" % (
-                  bytes_read,
-                  total_bytes,
-                  float(bytes_read)/total_bytes * 100,
-                  ))
+            if total_bytes:
+                print("Progress: %d of %d bytes (%0.2f%% complete)" % (
+                      bytes_read,
+                      total_bytes,
+                      float(bytes_read)/total_bytes * 100,
+                      ))
 
             decompressed_data = decompressor.decompress(data)
             if decompressed_data is not None:
                 f.write(decompressed_data)
 
 
-def build_all_types(cursor):
+def download_database(destination_path):
+    response = urllib2.urlopen(SQLITE_DUMP_URL)
+    total_bytes = int(response.info().getheader('Content-Length').strip())
+    decompress_database(response, destination_path, total_bytes)
 
-    inv_type_materials = collections.defaultdict(list)
-    for row in cursor.execute('SELECT * FROM invtypematerials'):
-        inv_type_materials[row['typeID']].append({
-            'type_id': row['typeID'],
-            'material_type_id': row['materialTypeID'],
-            'quantity': row['quantity'],
-        })
+
+def get_components(cursor):
+    """ Returns {typeID: [component, ...]} for the types that are priced
+        from their components.
+    """
+    components = defaultdict(list)
+    for type_id, material_type_id, quantity in cursor.execute('''
+SELECT
+    m.typeID,
+    m.materialTypeID,
+    m.quantity
+FROM invtypematerials m
+JOIN invtypes t ON t.typeID = m.typeID
+WHERE t.groupID IN (%s)''' % ','.join('?' * len(COMP_TYPES)), COMP_TYPES):
+        components[type_id].append({'typeID': type_id,
+                                    'materialTypeID': material_type_id,
+                                    'quantity': quantity})
+    return components
+
+
+def build_all_types(cursor):
+    """ Yields every type of the SDE, ordered by typeID. """
+    # Save the components for certain types that aren't commonly found on
+    # the market
+    components = get_components(cursor)
 
     for (type_id,
          group_id,
@@ -72,12 +106,13 @@ SELECT
     typeName,
     volume,
     marketGroupID
-FROM invtypes'''):
+FROM invtypes
+ORDER BY typeID'''):
 
-        print("Populating info for: %s" % type_name)
         try:
             type_name = type_name.decode('utf-8')
         except UnicodeDecodeError:
+            print("Skipping type %s, its name isn't valid UTF-8" % type_id)
             continue
 
         has_market = market_group_id is not None
@@ -88,43 +123,159 @@ FROM invtypes'''):
             'volume': volume or 0.0,
             'market': has_market,
         }
+        if type_id in components:
+            d['components'] = components[type_id]
+
+        yield d
 
-        # Save the components for certain types that aren't commonly found
-        # on the market
-        if (
-            group_id in COMP_TYPES and
-            type_id in inv_type_materials
-        ):
 
-            d['components'] = [{'typeID': material['type_id'],
-                                'materialTypeID': material['material_type_id'],
-                                'quantity': material['quantity']}
-                               for material
-                               in inv_type_materials[type_id]]
+def dump_type(t):
+    return json.dumps(t, sort_keys=True)
 
-        yield d
+
+def load_current_types(path):
+    """ Returns {typeID: type} as found in the current output. """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return dict((t['typeID'], t) for t in json.load(f))
+
+
+class TypesWriter(object):
+    """ Writes types to a JSON list, one type per line, as they come. The
+        output replaces path atomically once the writer is committed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        self.f = os.fdopen(fd, 'w')
+        self.f.write('[')
+
+    def write(self, t):
+        self.f.write(',\n' if self.count else '\n')
+        self.f.write(dump_type(t))
+        self.count += 1
+
+    def commit(self):
+        self.f.write('\n]\n')
+        self.f.close()
+        os.chmod(self.tmp_path, 0o644)
+        os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        self.f.close()
+        os.unlink(self.tmp_path)
+
+
+def describe_changes(old, new):
+    """ Returns the changelog lines for a type that changed from old to new,
+        either of which may be None.
+    """
+    if old is None:
+        return ["added %s %s" % (new['typeID'], new['typeName'])]
+    if new is None:
+        return ["removed %s %s" % (old['typeID'], old['typeName'])]
+
+    lines = []
+    if old['typeName'] != new['typeName']:
+        lines.append("renamed %s %s -> %s" % (
+            new['typeID'], old['typeName'], new['typeName']))
+    fields = sorted(key for key in set(old) | set(new)
+                    if key != 'typeName' and old.get(key) != new.get(key))
+    if fields:
+        lines.append("changed %s %s: %s" % (
+            new['typeID'], new['typeName'], ', '.join(fields)))
+    return lines
+
+
+def write_types(types, output_path, current=None):
+    """ Streams types to output_path. When current, the {typeID: type} of
+        the existing output, is given, returns the changelog and leaves the
+        output alone if there is nothing in it.
+    """
+    writer = TypesWriter(output_path)
+    changelog = []
+    try:
+        for t in types:
+            writer.write(t)
+            if current is not None:
+                changelog.extend(describe_changes(current.pop(t['typeID'],
+                                                              None), t))
+            if writer.count % 5000 == 0:
+                print("Wrote %d types" % writer.count)
+
+        if current is not None:
+            for type_id in sorted(current):
+                changelog.extend(describe_changes(current[type_id], None))
+            if not changelog:
+                writer.discard()
+                return changelog
+        writer.commit()
+    except Exception:
+        writer.discard()
+        raise
+    return changelog
+
+
+def write_changelog(changelog, path=None):
+    if not path:
+        for line in changelog:
+            print(line)
+        return
+    with open(path, 'a') as f:
+        f.write("# %s: %d changes\n" % (
+            time.strftime('%Y-%m-%d %H:%M:%S'), len(changelog)))
+        for line in changelog:
+            f.write(line.encode('utf-8') + '\n')
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sde', help='local SDE sqlite dump, plain or .bz2; '
+                                      'downloaded when not given')
+    parser.add_argument('--output', default='data/types.json')
+    parser.add_argument('--incremental', action='store_true',
+                        help='compare with the current output and only '
+                             'rewrite it when types changed')
+    parser.add_argument('--changelog',
+                        help='file to append the changelog to, printed '
+                             'when not given')
+    args = parser.parse_args()
+
     temp_dir = tempfile.mkdtemp()
     try:
-        db_path = os.path.join(temp_dir, 'eve-db.sqlite')
-        print("Writing sqlite database to %s" % db_path)
-        download_database(db_path)
+        db_path = args.sde
+        if not db_path or db_path.endswith('.bz2'):
+            db_path = os.path.join(temp_dir, 'eve-db.sqlite')
+            print("Writing sqlite database to %s" % db_path)
+            if args.sde:
+                with open(args.sde, 'rb') as f:
+                    decompress_database(f, db_path)
+            else:
+                download_database(db_path)
 
         print("Opening database file")
         conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
         conn.text_factory = str
         c = conn.cursor()
 
-        print("Build type information")
-        all_types = list(build_all_types(c))
+        current = None
+        if args.incremental:
+            current = load_current_types(args.output)
+            print("Comparing with %d types in %s" % (len(current),
+                                                     args.output))
 
-        types_output_file = 'data/types.json'
-        print("Output types to %s" % types_output_file)
-        with open(types_output_file, 'w') as f:
-            f.write(json.dumps(all_types, indent=2))
+        print("Output types to %s" % args.output)
+        changelog = write_types(build_all_types(c), args.output, current)
+        if args.incremental:
+            if changelog:
+                write_changelog(changelog, args.changelog)
+                print("%d changes" % len(changelog))
+            else:
+                print("No changes, %s is up to date" % args.output)
     finally:
         shutil.rmtree(temp_dir, [])
 
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# Runs the background price warmer. Start a single instance next to the web
+# workers, from the repository root:
+#   python tools/warm_prices.py          # refresh forever
+#   python tools/warm_prices.py --once   # run one cycle and exit
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from evepraisal import app, warmer  # NOQA
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--once', action='store_true',
+                        help='run a single refresh cycle and exit')
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.INFO)
+    with app.app_context():
+        if args.once:
+            warmer.run_cycle()
+            warmer.report_coverage()
+        else:
+            warmer.run_forever()
+
+
+if __name__ == '__main__':
+    main()